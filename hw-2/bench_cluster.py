@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import logging
+import random
+import selectors
+from time import perf_counter
+from typing import Optional
+
+import server as raft
+from metrics import METRICS
+from models import RaftRequest, Operation
+from node import Node
+from server import Server, LeadershipLost
+
+REQUEST_TIMEOUT = 5
+RETRY_DELAY = 0.05
+POLL_INTERVAL = 0.01
+# Writes of the runs with and without readers batch differently, the appends sent may differ a little
+APPENDS_TOLERANCE = 1.2
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    # Instead of sleeping until the next timer the clock jumps to it
+    def __init__(self) -> None:
+        super().__init__()
+        self.now: float = 0
+
+    def select(self, timeout: Optional[float] = None):
+        events = super().select(0)
+        if not events and timeout:
+            self.now += timeout
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self) -> None:
+        self.clock = VirtualTimeSelector()
+        super().__init__(self.clock)
+
+    def time(self) -> float:
+        return self.clock.now
+
+
+class Network:
+    def __init__(self, delay: float, jitter: float, loss: float, reorder: float) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.delay: float = delay
+        self.jitter: float = jitter
+        self.loss: float = loss
+        self.reorder: float = reorder
+        self.nodes: dict[tuple[str, int], Node] = {}
+        self.blocked: set[tuple[tuple[str, int], tuple[str, int]]] = set()
+        self.delivered: int = 0
+        self.dropped: int = 0
+
+    def attach(self, node: Node) -> "MemoryTransport":
+        self.nodes[node.address] = node
+        return MemoryTransport(self, node.address)
+
+    def partition(self, *sides: list[tuple[str, int]]) -> None:
+        for side in sides:
+            for other in sides:
+                if other is not side:
+                    self.blocked |= {(source, destination) for source in side for destination in other}
+
+    def isolate(self, address: tuple[str, int]) -> None:
+        self.partition([address], [other for other in raft.SERVERS.values() if other != address])
+
+    def heal(self) -> None:
+        self.blocked = set()
+
+    def send(self, source: tuple[str, int], data: bytes, destination: tuple[str, int]) -> None:
+        if (source, destination) in self.blocked or random.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.delay + random.uniform(0, self.jitter)
+        if random.random() < self.reorder:
+            # Held back long enough to arrive after messages sent later
+            delay += 5 * (self.delay + self.jitter)
+        self.loop.call_later(delay, self.deliver, source, data, destination)
+
+    def deliver(self, source: tuple[str, int], data: bytes, destination: tuple[str, int]) -> None:
+        node = self.nodes.get(destination)
+        if node is None or (source, destination) in self.blocked:
+            self.dropped += 1
+            return
+        self.delivered += 1
+        try:
+            node.receive(data)
+        except BaseException as exception:
+            logging.exception(exception)
+
+
+class MemoryTransport:
+    def __init__(self, network: Network, address: tuple[str, int]) -> None:
+        self.network = network
+        self.address = address
+
+    def sendto(self, data: bytes, address: tuple[str, int]) -> None:
+        self.network.send(self.address, data, address)
+
+    def close(self) -> None:
+        self.network.nodes.pop(self.address, None)
+
+
+def sent_appends(groups: int) -> tuple[float, float, float]:
+    return (METRICS.counter("raft_rpc_sent_total", type="appendEntry").value,
+            sum(METRICS.counter("raft_read_probes_total", group=str(group)).value for group in range(groups)),
+            sum(METRICS.counter("raft_entries_sent_total", group=str(group)).value for group in range(groups)))
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Cluster:
+    def __init__(self, size: int, groups: int, network: Network) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.network = network
+        raft.SERVERS.clear()
+        raft.SERVERS.update({id_: (f"10.0.0.{id_}", 32000) for id_ in range(size)})
+        self.nodes: dict[int, Node] = {}
+        for id_ in raft.SERVERS.keys():
+            # Election timeout is drawn once per process, every simulated node needs its own
+            raft.ELECTION_TIMEOUT = raft.MIN_ELECTION_TIMEOUT + random.randint(0, 100) / 10
+            self.nodes[id_] = Node(id_, None, groups)
+
+    async def start(self) -> None:
+        for node in self.nodes.values():
+            await node.start(self.network.attach(node))
+
+    def crash(self, id_: int) -> None:
+        self.nodes.pop(id_).stop()
+
+    def leader(self, group: int) -> Optional[Server]:
+        leaders = [node.groups[group] for node in self.nodes.values() if node.groups[group].isLeader()]
+        return max(leaders, key=lambda server: server.term) if leaders else None
+
+    async def elect(self, group: int) -> Server:
+        # Leader counts once an entry of its own term is committed, so it can serve clients
+        while True:
+            leader = self.leader(group)
+            if leader is not None and leader.log.term_at(leader.last_applied) == leader.term:
+                return leader
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def write(self, key: str, value: int) -> float:
+        group = self.nodes[next(iter(self.nodes))].route(key).group
+        while True:
+            leader = self.leader(group)
+            if leader is None:
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            start = self.loop.time()
+            try:
+                await asyncio.wait_for(leader.serve_client(RaftRequest(key=key, value=value), Operation.PUT),
+                                       REQUEST_TIMEOUT)
+                return self.loop.time() - start
+            except (LeadershipLost, asyncio.TimeoutError):
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def load(self, writes: int, concurrency: int) -> list[float]:
+        latencies: list[float] = []
+        counter = iter(range(writes))
+
+        async def client() -> None:
+            for i in counter:
+                latencies.append(await self.write(f"key-{i % 1000}", i))
+
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+        return latencies
+
+    async def read(self, key: str) -> None:
+        group = self.nodes[next(iter(self.nodes))].route(key).group
+        while True:
+            leader = self.leader(group)
+            if leader is None:
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            try:
+                await asyncio.wait_for(leader.read(key), REQUEST_TIMEOUT)
+                return
+            except (LeadershipLost, asyncio.TimeoutError):
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def load_with_readers(self, writes: int, concurrency: int, readers: int) -> list[float]:
+        done = asyncio.Event()
+
+        async def reader(i: int) -> None:
+            while not done.is_set():
+                await self.read(f"key-{i}")
+
+        tasks = [asyncio.create_task(reader(i)) for i in range(readers)]
+        latencies = await self.load(writes, concurrency)
+        done.set()
+        await asyncio.gather(*tasks)
+        return latencies
+
+    async def catch_up(self, id_: int) -> None:
+        node = self.nodes[id_]
+        while True:
+            behind = [server for server in node.groups
+                      if (leader := self.leader(server.group)) is not None and server.last_applied < leader.commit_index]
+            if not behind:
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+async def run(args: argparse.Namespace) -> None:
+    loop = asyncio.get_running_loop()
+    network = Network(args.delay, args.jitter, args.loss, args.reorder)
+    cluster = Cluster(args.servers, args.groups, network)
+    await cluster.start()
+
+    start = loop.time()
+    leaders = [await cluster.elect(group) for group in range(args.groups)]
+    print(f"{'first election':<24}{loop.time() - start:>12.3f} s")
+
+    start, wall = loop.time(), perf_counter()
+    latencies = await cluster.load(args.writes, args.concurrency)
+    elapsed, wall = loop.time() - start, perf_counter() - wall
+    print(f"{'writes/s (virtual)':<24}{len(latencies) / elapsed:>12.0f}")
+    print(f"{'writes/s (wall clock)':<24}{len(latencies) / wall:>12.0f}")
+    print(f"{'commit latency p50':<24}{percentile(latencies, 0.5) * 1000:>12.2f} ms")
+    print(f"{'commit latency p99':<24}{percentile(latencies, 0.99) * 1000:>12.2f} ms")
+
+    # Reads confirm leadership with empty appends of their own, replication traffic must not grow with them
+    sent: list[tuple[float, float, float]] = []
+    for readers in (0, args.readers):
+        before = sent_appends(args.groups)
+        await cluster.load_with_readers(args.writes, args.concurrency, readers)
+        sent.append(tuple(after - value for after, value in zip(sent_appends(args.groups), before)))
+        appends, probes, entries = sent[-1]
+        print(f"{f'appends, {readers} readers':<24}{appends - probes:>12.0f}")
+        print(f"{f'read probes, {readers} readers':<24}{probes:>12.0f}")
+        print(f"{f'entries, {readers} readers':<24}{entries:>12.0f}")
+    (appends, probes, entries), (read_appends, read_probes, read_entries) = sent
+    # Lost datagrams make the leader resend by chance, only a lossless network shows what reads cost
+    resent = (not args.loss and not args.reorder and
+              (read_appends - read_probes > (appends - probes) * APPENDS_TOLERANCE or
+               read_entries > entries * APPENDS_TOLERANCE))
+
+    follower = next(id_ for id_ in cluster.nodes.keys() if id_ != leaders[0].id)
+    network.isolate(raft.SERVERS[follower])
+    await cluster.load(args.writes, args.concurrency)
+    network.heal()
+    start = loop.time()
+    await cluster.catch_up(follower)
+    print(f"{'follower catch-up':<24}{loop.time() - start:>12.3f} s")
+
+    cluster.crash(leaders[0].id)
+    start = loop.time()
+    await cluster.elect(0)
+    print(f"{'election after crash':<24}{loop.time() - start:>12.3f} s")
+    print(f"{'messages delivered':<24}{network.delivered:>12}")
+    print(f"{'messages dropped':<24}{network.dropped:>12}")
+
+    for node in cluster.nodes.values():
+        node.stop()
+    await asyncio.sleep(0)
+    if resent:
+        raise SystemExit("Reads made the leader resend entries")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs a Raft cluster in one process over a simulated network")
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--groups", type=int, default=1)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--readers", type=int, default=8, help="clients reading while the writes run")
+    parser.add_argument("--delay", type=float, default=0.001, help="one way network delay, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0005, help="random extra delay, seconds")
+    parser.add_argument("--loss", type=float, default=0, help="probability to drop a datagram")
+    parser.add_argument("--reorder", type=float, default=0, help="probability to hold a datagram back")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--real-time", action="store_true", help="run on the wall clock instead of virtual time")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.new_event_loop() if args.real_time else VirtualTimeLoop()
+    loop.run_until_complete(run(args))
+    loop.close()
@@ -0,0 +1,60 @@
+import sys
+from time import perf_counter
+
+from codec import CODECS
+from log import Entry, Event
+from rpc import (AppendEntry, AppendEntryResponse, RequestVote, RequestVoteResponse, InstallSnapshot,
+                 InstallSnapshotResponse, ReadIndex, ReadIndexResponse, MessageType, RPC)
+
+
+def sample_rpcs(batch_size: int) -> dict[str, RPC]:
+    entries = [Entry(7, Event.PUT, f"key-{i}", i * 1000) for i in range(batch_size)]
+    entries[0] = Entry(7)
+    return {
+        "appendEntry(heartbeat)": RPC(2, 7, MessageType.APPEND_ENTRY, AppendEntry([], 120, 7, 118, 31)),
+        f"appendEntry({batch_size} entries)": RPC(2, 7, MessageType.APPEND_ENTRY, AppendEntry(entries, 120, 7, 118, 31), 3),
+        "appendEntryResponse": RPC(3, 7, MessageType.APPEND_ENTRY_RESPONSE, AppendEntryResponse(False, 184, 6, 150, 31, 12)),
+        "requestVote": RPC(4, 8, MessageType.REQUEST_VOTE, RequestVote(184, 7)),
+        "requestVoteResponse": RPC(3, 8, MessageType.REQUEST_VOTE_RESPONSE, RequestVoteResponse(True)),
+        "installSnapshot": RPC(2, 7, MessageType.INSTALL_SNAPSHOT,
+                               InstallSnapshot(4096, 7, 8192, '{"key": 1, ' * 512, False,
+                                                               '{"voters": {"2": ["127.0.0.2", 32000]}}')),
+        "installSnapshotResponse": RPC(3, 7, MessageType.INSTALL_SNAPSHOT_RESPONSE,
+                                       InstallSnapshotResponse(4096, 12288, False)),
+        "readIndex": RPC(3, 7, MessageType.READ_INDEX, ReadIndex(42)),
+        "readIndexResponse": RPC(2, 7, MessageType.READ_INDEX_RESPONSE, ReadIndexResponse(42, 184)),
+    }
+
+
+def check_round_trip(rpcs: dict[str, RPC]) -> None:
+    for codec_name, codec in CODECS.items():
+        for name, rpc in rpcs.items():
+            decoded = codec.decode(codec.encode(rpc))
+            if decoded != rpc:
+                raise RuntimeError(f"{codec_name} codec broke {name}: {rpc} != {decoded}")
+
+
+def measure(function, argument, duration: float) -> float:
+    calls = 0
+    start = perf_counter()
+    while perf_counter() - start < duration:
+        for _ in range(100):
+            function(argument)
+        calls += 100
+    return calls / (perf_counter() - start)
+
+
+def bench(batch_size: int, duration: float) -> None:
+    rpcs = sample_rpcs(batch_size)
+    check_round_trip(rpcs)
+    print(f"{'message':<26}{'codec':<8}{'bytes':>8}{'encode/s':>12}{'decode/s':>12}")
+    for name, rpc in rpcs.items():
+        for codec_name, codec in CODECS.items():
+            data = codec.encode(rpc)
+            encodes = measure(codec.encode, rpc, duration)
+            decodes = measure(codec.decode, data, duration)
+            print(f"{name:<26}{codec_name:<8}{len(data):>8}{encodes:>12.0f}{decodes:>12.0f}")
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 64, float(sys.argv[2]) if len(sys.argv) > 2 else 0.5)
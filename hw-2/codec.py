@@ -0,0 +1,145 @@
+import json
+import struct
+
+from log import Entry, encode_entry, decode_entry
+from rpc import (AppendEntry, AppendEntryResponse, RequestVote, RequestVoteResponse, InstallSnapshot,
+                 InstallSnapshotResponse, ReadIndex, ReadIndexResponse, MessageType, RPC)
+
+
+class JsonCodec:
+    @staticmethod
+    def encode(rpc: RPC) -> bytes:
+        return json.dumps(rpc, default=lambda obj: obj.__json__()).encode('utf-8')
+
+    @staticmethod
+    def decode(data: bytes) -> RPC:
+        return RPC.from_json(data)
+
+
+# Header: version, message type, sender, raft group, term
+HEADER = struct.Struct("!BBHHq")
+APPEND_ENTRY = struct.Struct("!qqqqI")
+APPEND_ENTRY_RESPONSE = struct.Struct("!?qqqqI")
+REQUEST_VOTE = struct.Struct("!qq")
+REQUEST_VOTE_RESPONSE = struct.Struct("!?")
+# Install snapshot: last included index, last included term, offset, done, data and configuration size;
+# followed by the data and the configuration
+INSTALL_SNAPSHOT = struct.Struct("!qqq?II")
+INSTALL_SNAPSHOT_RESPONSE = struct.Struct("!qq?")
+READ_INDEX = struct.Struct("!q")
+READ_INDEX_RESPONSE = struct.Struct("!qq")
+
+VERSION = 4
+# Datagram carrying several messages: message count, then every message prefixed with its size
+BATCH = struct.Struct("!H")
+FRAME = struct.Struct("!I")
+
+MESSAGE_CODES = {
+    MessageType.APPEND_ENTRY: 0,
+    MessageType.APPEND_ENTRY_RESPONSE: 1,
+    MessageType.REQUEST_VOTE: 2,
+    MessageType.REQUEST_VOTE_RESPONSE: 3,
+    MessageType.INSTALL_SNAPSHOT: 4,
+    MessageType.INSTALL_SNAPSHOT_RESPONSE: 5,
+    MessageType.READ_INDEX: 6,
+    MessageType.READ_INDEX_RESPONSE: 7,
+}
+MESSAGE_TYPES = {code: message_type for message_type, code in MESSAGE_CODES.items()}
+
+
+class BinaryCodec:
+    @staticmethod
+    def encode(rpc: RPC) -> bytes:
+        parts: list[bytes] = [HEADER.pack(VERSION, MESSAGE_CODES[rpc.message_type], rpc.sender, rpc.group, rpc.term)]
+        message = rpc.message
+        match rpc.message_type:
+            case MessageType.APPEND_ENTRY:
+                parts.append(APPEND_ENTRY.pack(message.prev_entry_idx, message.prev_entry_term, message.commit_idx,
+                                               message.read_round, len(message.entries)))
+                for entry in message.entries:
+                    encode_entry(entry, parts)
+            case MessageType.APPEND_ENTRY_RESPONSE:
+                parts.append(APPEND_ENTRY_RESPONSE.pack(message.success, message.last_entry_idx, message.conflict_term,
+                                                        message.conflict_idx, message.read_round,
+                                                        message.entry_count))
+            case MessageType.REQUEST_VOTE:
+                parts.append(REQUEST_VOTE.pack(message.last_entry_idx, message.last_entry_term))
+            case MessageType.REQUEST_VOTE_RESPONSE:
+                parts.append(REQUEST_VOTE_RESPONSE.pack(message.vote_granted))
+            case MessageType.INSTALL_SNAPSHOT:
+                data = message.data.encode('utf-8')
+                configuration = message.configuration.encode('utf-8')
+                parts.append(INSTALL_SNAPSHOT.pack(message.last_included_idx, message.last_included_term,
+                                                   message.offset, message.done, len(data), len(configuration)))
+                parts.append(data)
+                parts.append(configuration)
+            case MessageType.INSTALL_SNAPSHOT_RESPONSE:
+                parts.append(INSTALL_SNAPSHOT_RESPONSE.pack(message.last_included_idx, message.offset, message.done))
+            case MessageType.READ_INDEX:
+                parts.append(READ_INDEX.pack(message.request_id))
+            case MessageType.READ_INDEX_RESPONSE:
+                parts.append(READ_INDEX_RESPONSE.pack(message.request_id, message.read_index))
+        return b"".join(parts)
+
+    @staticmethod
+    def decode(data: bytes) -> RPC:
+        version, code, sender, group, term = HEADER.unpack_from(data, 0)
+        if version != VERSION:
+            raise RuntimeError(f"Unsupported wire protocol version {version}")
+        message_type = MESSAGE_TYPES[code]
+        offset = HEADER.size
+        match message_type:
+            case MessageType.APPEND_ENTRY:
+                prev_entry_idx, prev_entry_term, commit_idx, read_round, count = APPEND_ENTRY.unpack_from(data, offset)
+                offset += APPEND_ENTRY.size
+                entries: list[Entry] = []
+                for _ in range(count):
+                    entry, offset = decode_entry(data, offset)
+                    entries.append(entry)
+                message = AppendEntry(entries, prev_entry_idx, prev_entry_term, commit_idx, read_round)
+            case MessageType.APPEND_ENTRY_RESPONSE:
+                message = AppendEntryResponse(*APPEND_ENTRY_RESPONSE.unpack_from(data, offset))
+            case MessageType.REQUEST_VOTE:
+                message = RequestVote(*REQUEST_VOTE.unpack_from(data, offset))
+            case MessageType.REQUEST_VOTE_RESPONSE:
+                message = RequestVoteResponse(*REQUEST_VOTE_RESPONSE.unpack_from(data, offset))
+            case MessageType.INSTALL_SNAPSHOT:
+                last_included_idx, last_included_term, snapshot_offset, done, size, configuration_size = \
+                    INSTALL_SNAPSHOT.unpack_from(data, offset)
+                offset += INSTALL_SNAPSHOT.size
+                message = InstallSnapshot(last_included_idx, last_included_term, snapshot_offset,
+                                          data[offset: offset + size].decode('utf-8'), done,
+                                          data[offset + size: offset + size + configuration_size].decode('utf-8'))
+            case MessageType.INSTALL_SNAPSHOT_RESPONSE:
+                message = InstallSnapshotResponse(*INSTALL_SNAPSHOT_RESPONSE.unpack_from(data, offset))
+            case MessageType.READ_INDEX:
+                message = ReadIndex(*READ_INDEX.unpack_from(data, offset))
+            case MessageType.READ_INDEX_RESPONSE:
+                message = ReadIndexResponse(*READ_INDEX_RESPONSE.unpack_from(data, offset))
+        return RPC(sender, term, message_type, message, group)
+
+
+def pack_batch(messages: list[bytes]) -> bytes:
+    parts: list[bytes] = [BATCH.pack(len(messages))]
+    for message in messages:
+        parts.append(FRAME.pack(len(message)))
+        parts.append(message)
+    return b"".join(parts)
+
+
+def unpack_batch(data: bytes) -> list[bytes]:
+    (count,) = BATCH.unpack_from(data, 0)
+    offset = BATCH.size
+    messages: list[bytes] = []
+    for _ in range(count):
+        (size,) = FRAME.unpack_from(data, offset)
+        offset += FRAME.size
+        messages.append(data[offset: offset + size])
+        offset += size
+    return messages
+
+
+CODECS = {
+    "json": JsonCodec,
+    "binary": BinaryCodec,
+}
@@ -1,10 +1,18 @@
 import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
 from enum import IntEnum
-from typing import Optional
+from typing import BinaryIO, Optional
 
 from dataclasses_json import dataclass_json
 from dataclasses import dataclass
 
+logger = logging.getLogger("raft.log")
+
 
 class Event(IntEnum):
     NOOP = 0
@@ -12,43 +20,469 @@ class Event(IntEnum):
     POST = 2
     PUT = 3
     DELETE = 4
+    BATCH = 5
+    # Cluster configuration change, the key holds the encoded configuration
+    CONFIG = 6
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class Entry:
     term: int
     event: Event = Event.NOOP
     key: Optional[str] = None
     value: Optional[int] = None
+    # Operations of a batch entry, applied together at its index
+    operations: Optional[list["Entry"]] = None
 
     def __json__(self):
-        return {"term": self.term, "event": self.event, "key": self.key, "value": self.value}
+        return {"term": self.term, "event": self.event, "key": self.key, "value": self.value,
+                "operations": self.operations}
+
+
+# Entry: term, event, flags; followed by the optional key, value and batch operations
+ENTRY = struct.Struct("!qBB")
+KEY_SIZE = struct.Struct("!H")
+VALUE = struct.Struct("!q")
+OPERATIONS = struct.Struct("!I")
+HAS_KEY = 1
+HAS_VALUE = 2
+HAS_OPERATIONS = 4
+# Bounds of the fixed size fields that keys and values are stored in
+MAX_KEY_LENGTH = 2 ** 16 - 1
+MIN_VALUE = -2 ** 63
+MAX_VALUE = 2 ** 63 - 1
+
+
+def check_entry(entry: Entry) -> None:
+    # Short keys fit whatever characters they hold, only the long ones are encoded to be measured
+    if (entry.key is not None and len(entry.key) > MAX_KEY_LENGTH // 4 and
+            len(entry.key.encode('utf-8')) > MAX_KEY_LENGTH):
+        raise ValueError(f"Key is longer than {MAX_KEY_LENGTH} bytes")
+    if entry.value is not None and not MIN_VALUE <= entry.value <= MAX_VALUE:
+        raise ValueError(f"Value {entry.value} is out of the 64 bit range")
+    for operation in entry.operations or ():
+        check_entry(operation)
+
+
+def encode_entry(entry: Entry, parts: list[bytes]) -> None:
+    flags = ((HAS_KEY if entry.key is not None else 0) | (HAS_VALUE if entry.value is not None else 0) |
+             (HAS_OPERATIONS if entry.operations is not None else 0))
+    parts.append(ENTRY.pack(entry.term, entry.event, flags))
+    if entry.key is not None:
+        key = entry.key.encode('utf-8')
+        parts.append(KEY_SIZE.pack(len(key)))
+        parts.append(key)
+    if entry.value is not None:
+        parts.append(VALUE.pack(entry.value))
+    if entry.operations is not None:
+        parts.append(OPERATIONS.pack(len(entry.operations)))
+        for operation in entry.operations:
+            encode_entry(operation, parts)
+
+
+def entry_size(entry: Entry) -> int:
+    # Size of the encoded entry, without encoding it
+    size = ENTRY.size
+    if entry.key is not None:
+        size += KEY_SIZE.size + len(entry.key.encode('utf-8'))
+    if entry.value is not None:
+        size += VALUE.size
+    if entry.operations is not None:
+        size += OPERATIONS.size + sum(entry_size(operation) for operation in entry.operations)
+    return size
+
+
+def decode_entry(data: bytes, offset: int) -> tuple[Entry, int]:
+    term, event, flags = ENTRY.unpack_from(data, offset)
+    offset += ENTRY.size
+    key: Optional[str] = None
+    value: Optional[int] = None
+    if flags & HAS_KEY:
+        size, = KEY_SIZE.unpack_from(data, offset)
+        offset += KEY_SIZE.size
+        key = data[offset: offset + size].decode('utf-8')
+        offset += size
+    if flags & HAS_VALUE:
+        value, = VALUE.unpack_from(data, offset)
+        offset += VALUE.size
+    operations: Optional[list[Entry]] = None
+    if flags & HAS_OPERATIONS:
+        count, = OPERATIONS.unpack_from(data, offset)
+        offset += OPERATIONS.size
+        operations = []
+        for _ in range(count):
+            operation, offset = decode_entry(data, offset)
+            operations.append(operation)
+    return Entry(term, Event(event), key, value, operations), offset
+
+
+class Record(IntEnum):
+    ENTRY = 0
+    TRUNCATE = 1
+    STATE = 2
+
+
+# Record header: type, payload size, payload crc32
+RECORD = struct.Struct("!BII")
+INDEX = struct.Struct("!q")
+STATE = struct.Struct("!qq")
+# Snapshot header: last included index, last included term, crc32 and size of the configuration; followed by
+# the configuration and the data
+SNAPSHOT = struct.Struct("!qqII")
+SEGMENT_SIZE = 64 * 1024 * 1024
 
 
 class Log:
-    def __init__(self):
-        self.entries: list[Entry] = [Entry(term=0)]
+    def __init__(self, path: Optional[str] = None):
+        # Entries are stored column by column, the first row stands for the last entry covered by the snapshot
+        self.terms: array = array('q')
+        self.events: bytearray = bytearray()
+        self.keys: list[Optional[str]] = []
+        self.values: array = array('q')
+        self.flags: bytearray = bytearray()
+        # Encoded size of the log up to and including every entry, so the size of any range is a subtraction
+        self.ends: array = array('q')
+        # Operations of batch entries by their index, the rare batches do not get a column of their own
+        self.operations: dict[int, list[Entry]] = {}
+        # Indices of configuration entries, and the latest configuration covered by the snapshot
+        self.config_indices: list[int] = []
+        self.base_config: Optional[str] = None
+        # First index of every term present in the log, in log order
+        self.run_terms: list[int] = []
+        self.run_starts: list[int] = []
+        self.base_index: int = 0
+        self.reset(0, 0)
+        self.snapshot: Optional[str] = None
+        self.term: int = 0
+        self.voted_for: Optional[int] = None
+        self.path: Optional[str] = path
+        self.segment: Optional[BinaryIO] = None
+        self.segment_number: int = 0
+        self.dirty: bool = False
+        self.synced_index: int = 0
+        if path is not None:
+            self.recover()
 
-    def add_entry(self, entry: Entry, prev_entry_idx: int, prev_entry_term: int) -> bool:
-        if len(self.entries) <= prev_entry_idx or self.entries[prev_entry_idx].term != prev_entry_term:
-            logging.info(f"Previous entry doesn't exist or isn't consistent with provided")
+    def add_entries(self, entries: list[Entry], prev_entry_idx: int, prev_entry_term: int) -> bool:
+        if prev_entry_idx < self.base_index:
+            # Entries covered by the snapshot are committed, so they match the provided ones
+            entries = entries[self.base_index - prev_entry_idx:]
+            prev_entry_idx = self.base_index
+            prev_entry_term = self.terms[0]
+        if self.size() <= prev_entry_idx or self.term_at(prev_entry_idx) != prev_entry_term:
+            logger.info("Previous entry doesn't exist or isn't consistent with provided")
             return False
-        if entry is None:
-            return True
-        if len(self.entries) == prev_entry_idx + 1:
-            logging.info(f"Add new entry")
-            self.entries += [entry]
-        elif self.entries[prev_entry_idx + 1].term != entry.term:
-            logging.info(f"Current entry is not consistent with provided. Remove it with all subsequent entries")
-            self.entries = self.entries[:prev_entry_idx + 1] + [entry]
+        for offset, entry in enumerate(entries):
+            index = prev_entry_idx + 1 + offset
+            if self.size() == index:
+                logger.debug("Add %s new entries", len(entries) - offset)
+                self.append(entries[offset:])
+                break
+            if self.term_at(index) != entry.term:
+                logger.info("Entry %s is not consistent with provided. Remove it with all subsequent entries", index)
+                self.truncate(index)
+                self.append(entries[offset:])
+                break
         return True
 
+    def append(self, entries: list[Entry]) -> None:
+        # Every entry is checked before the first column changes, a failed append leaves the columns aligned
+        for entry in entries:
+            check_entry(entry)
+        start = self.size()
+        for entry in entries:
+            self.append_entry(entry)
+        if self.path is not None:
+            self.append_records(start)
+
+    def append_entry(self, entry: Entry) -> None:
+        if entry.term != self.run_terms[-1]:
+            self.run_terms.append(entry.term)
+            self.run_starts.append(self.size())
+        self.terms.append(entry.term)
+        self.events.append(entry.event)
+        self.keys.append(None if entry.key is None else sys.intern(entry.key))
+        self.values.append(0 if entry.value is None else entry.value)
+        self.flags.append(HAS_VALUE if entry.value is not None else 0)
+        self.ends.append(self.ends[-1] + entry_size(entry))
+        if entry.operations is not None:
+            self.operations[self.size() - 1] = entry.operations
+        if entry.event == Event.CONFIG:
+            self.config_indices.append(self.size() - 1)
+
+    def truncate(self, index: int) -> None:
+        if self.path is not None:
+            self.write(Record.TRUNCATE, INDEX.pack(index))
+        self.drop_suffix(index)
+        self.synced_index = min(self.synced_index, index - 1)
+
+    def drop_suffix(self, index: int) -> None:
+        position = index - self.base_index
+        del self.terms[position:]
+        del self.events[position:]
+        del self.keys[position:]
+        del self.values[position:]
+        del self.flags[position:]
+        del self.ends[position:]
+        if self.operations:
+            self.operations = {i: operations for i, operations in self.operations.items() if i < index}
+        while self.config_indices and self.config_indices[-1] >= index:
+            self.config_indices.pop()
+        while self.run_starts[-1] >= index:
+            self.run_terms.pop()
+            self.run_starts.pop()
+
+    def drop_prefix(self, index: int, term: int) -> None:
+        # Row of the new base entry is kept and reset, it only carries the term from now on
+        position = index - self.base_index
+        self.base_config = self.config_at(index)
+        del self.config_indices[:bisect_left(self.config_indices, index + 1)]
+        del self.terms[:position]
+        del self.events[:position]
+        del self.keys[:position]
+        del self.values[:position]
+        del self.flags[:position]
+        del self.ends[:position]
+        self.terms[0], self.events[0], self.keys[0], self.values[0], self.flags[0] = term, Event.NOOP, None, 0, 0
+        if self.operations:
+            self.operations = {i: operations for i, operations in self.operations.items() if i > index}
+        self.base_index = index
+        runs = max(bisect_left(self.run_starts, index + 1) - 1, 0)
+        del self.run_terms[:runs]
+        del self.run_starts[:runs]
+        self.run_terms[0], self.run_starts[0] = term, index
+
+    def reset(self, index: int, term: int, config: Optional[str] = None) -> None:
+        self.terms = array('q', [term])
+        self.events = bytearray([Event.NOOP])
+        self.keys = [None]
+        self.values = array('q', [0])
+        self.flags = bytearray([0])
+        self.ends = array('q', [0])
+        self.operations = {}
+        self.config_indices = []
+        self.base_config = config
+        self.run_terms = [term]
+        self.run_starts = [index]
+        self.base_index = index
+
+    def compact(self, index: int, snapshot: str, path: Optional[str]) -> None:
+        # Snapshot file at path was written by write_snapshot, it replaces the current one only if it is newer
+        if index <= self.base_index:
+            logger.info("Log is already compacted up to %s, drop the snapshot up to %s", self.base_index, index)
+            if path is not None:
+                os.remove(path)
+            return
+        logger.info("Compact log up to %s", index)
+        self.drop_prefix(index, self.term_at(index))
+        self.snapshot = snapshot
+        if path is not None:
+            self.replace_snapshot(path)
+
+    def install_snapshot(self, index: int, term: int, snapshot: str, config: Optional[str]) -> None:
+        if self.base_index < index < self.size() and self.term_at(index) == term:
+            logger.info("Install snapshot up to %s, keep the following entries", index)
+            self.drop_prefix(index, term)
+        else:
+            logger.info("Install snapshot up to %s, discard the whole log", index)
+            self.reset(index, term)
+        self.base_config = config
+        self.snapshot = snapshot
+        if self.path is not None:
+            self.replace_snapshot(self.write_snapshot(index, term, config, snapshot))
+        self.synced_index = self.size() - 1
+
+    def write_snapshot(self, index: int, term: int, config: Optional[str], snapshot: str) -> Optional[str]:
+        # Touches nothing but its own file, so a large snapshot can be written outside the event loop
+        if self.path is None:
+            return None
+        config = (config or "").encode('utf-8')
+        data = config + snapshot.encode('utf-8')
+        path = os.path.join(self.path, f"snapshot.{index}.tmp")
+        with open(path, "wb") as file:
+            file.write(SNAPSHOT.pack(index, term, zlib.crc32(data), len(config)))
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        return path
+
+    def replace_snapshot(self, path: str) -> None:
+        os.replace(path, os.path.join(self.path, "snapshot"))
+        # Entries left after the snapshot move to a fresh segment, older segments are not needed anymore
+        self.sync()
+        self.segment.close()
+        old_numbers = range(self.segment_number + 1)
+        self.segment_number += 1
+        self.segment = open(self.segment_path(self.segment_number), "ab")
+        self.write(Record.STATE, STATE.pack(self.term, -1 if self.voted_for is None else self.voted_for))
+        self.append_records(self.base_index + 1)
+        self.sync()
+        for number in old_numbers:
+            if os.path.exists(self.segment_path(number)):
+                os.remove(self.segment_path(number))
+
+    def append_records(self, start: int) -> None:
+        for index in range(start, self.size()):
+            parts: list[bytes] = [INDEX.pack(index)]
+            encode_entry(self[index], parts)
+            self.write(Record.ENTRY, b"".join(parts))
+
+    def save_state(self, term: int, voted_for: Optional[int]) -> None:
+        if self.term == term and self.voted_for == voted_for:
+            return
+        self.term = term
+        self.voted_for = voted_for
+        if self.path is not None:
+            self.write(Record.STATE, STATE.pack(term, -1 if voted_for is None else voted_for))
+
+    def write(self, record: Record, payload: bytes) -> None:
+        if self.segment.tell() >= SEGMENT_SIZE:
+            self.rotate()
+        self.segment.write(RECORD.pack(record, len(payload), zlib.crc32(payload)))
+        self.segment.write(payload)
+        self.dirty = True
+
+    def sync(self) -> None:
+        # Records are buffered until sync, so one fsync covers every append since the previous one
+        if self.dirty:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.dirty = False
+        self.synced_index = self.size() - 1
+
+    def rotate(self) -> None:
+        self.sync()
+        self.segment.close()
+        self.segment_number += 1
+        self.segment = open(self.segment_path(self.segment_number), "ab")
+        # A new segment starts with the state, so older segments only hold entries
+        self.write(Record.STATE, STATE.pack(self.term, -1 if self.voted_for is None else self.voted_for))
+
+    def segment_path(self, number: int) -> str:
+        return os.path.join(self.path, f"{number:08d}.segment")
+
+    def recover(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                # Snapshot written before a crash but never put in place
+                os.remove(os.path.join(self.path, name))
+        self.load_snapshot()
+        numbers = sorted(int(name.split(".")[0]) for name in os.listdir(self.path) if name.endswith(".segment"))
+        for number in numbers:
+            self.segment_number = number
+            self.replay(self.segment_path(number))
+        logger.info("Recovered snapshot up to %s, %s entries, term %s and vote %s from %s segments",
+                    self.base_index, len(self.terms) - 1, self.term, self.voted_for, len(numbers))
+        self.segment = open(self.segment_path(self.segment_number), "ab")
+        self.synced_index = self.size() - 1
+
+    def load_snapshot(self) -> None:
+        path = os.path.join(self.path, "snapshot")
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as snapshot:
+            data = snapshot.read()
+        index, term, checksum, config_size = SNAPSHOT.unpack_from(data, 0)
+        if zlib.crc32(data[SNAPSHOT.size:]) != checksum:
+            raise RuntimeError(f"Snapshot {path} is corrupted")
+        config = data[SNAPSHOT.size: SNAPSHOT.size + config_size].decode('utf-8')
+        self.reset(index, term, config or None)
+        self.snapshot = data[SNAPSHOT.size + config_size:].decode('utf-8')
+
+    def replay(self, path: str) -> None:
+        with open(path, "rb") as segment:
+            data = segment.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            record, size, checksum = RECORD.unpack_from(data, offset)
+            payload = data[offset + RECORD.size: offset + RECORD.size + size]
+            if len(payload) != size or zlib.crc32(payload) != checksum:
+                break
+            offset += RECORD.size + size
+            match record:
+                case Record.ENTRY:
+                    index, = INDEX.unpack_from(payload, 0)
+                    if index <= self.base_index or index > self.size():
+                        continue
+                    self.drop_suffix(index)
+                    self.append_entry(decode_entry(payload, INDEX.size)[0])
+                case Record.TRUNCATE:
+                    index, = INDEX.unpack_from(payload, 0)
+                    self.drop_suffix(max(index, self.base_index + 1))
+                case Record.STATE:
+                    self.term, voted_for = STATE.unpack_from(payload, 0)
+                    self.voted_for = None if voted_for == -1 else voted_for
+        if offset != len(data):
+            logger.warning("Segment %s has a torn or corrupted tail at %s, truncate it", path, offset)
+            with open(path, "r+b") as segment:
+                segment.truncate(offset)
+
     def size(self) -> int:
-        return len(self.entries)
+        return self.base_index + len(self.terms)
+
+    def term_at(self, index: int) -> int:
+        return self.terms[index - self.base_index]
+
+    def last_term(self) -> int:
+        return self.terms[-1]
+
+    def first_index(self, term: int) -> Optional[int]:
+        run = bisect_left(self.run_terms, term)
+        if run == len(self.run_terms) or self.run_terms[run] != term:
+            return None
+        return self.run_starts[run]
+
+    def last_index(self, term: int) -> Optional[int]:
+        run = bisect_left(self.run_terms, term)
+        if run == len(self.run_terms) or self.run_terms[run] != term:
+            return None
+        return self.run_starts[run + 1] - 1 if run + 1 < len(self.run_starts) else self.size() - 1
+
+    def conflict(self, index: int) -> tuple[int, int]:
+        # Term of the entry at index and the first index of that term, or no term and the log size when it is missing
+        if index >= self.size():
+            return -1, self.size()
+        term = self.term_at(index)
+        return term, max(self.first_index(term), self.base_index + 1)
+
+    def config_at(self, index: int) -> Optional[str]:
+        # Latest configuration at or before index
+        covered = bisect_left(self.config_indices, index + 1)
+        return self.keys[self.config_indices[covered - 1] - self.base_index] if covered else self.base_config
+
+    def encoded_size(self) -> int:
+        # Size of the entries after the snapshot as they are encoded on disk and on the wire
+        return self.ends[-1] - self.ends[0]
+
+    def configuration(self) -> tuple[int, Optional[str]]:
+        # Latest configuration in the log, committed or not, with its index
+        if self.config_indices:
+            return self.config_indices[-1], self.keys[self.config_indices[-1] - self.base_index]
+        return self.base_index, self.base_config
+
+    def entry(self, position: int) -> Entry:
+        return Entry(self.terms[position], Event(self.events[position]), self.keys[position],
+                     self.values[position] if self.flags[position] & HAS_VALUE else None,
+                     self.operations.get(self.base_index + position))
+
+    def __getitem__(self, key: int | slice):
+        if isinstance(key, slice):
+            return [self.entry(position) for position in range(key.start - self.base_index,
+                                                               min(key.stop, self.size()) - self.base_index)]
+        if key < 0:
+            return self.entry(len(self.terms) + key)
+        return self.entry(key - self.base_index)
+
+    def summary(self):
+        return {"base_index": self.base_index, "size": self.size(), "last_term": self.last_term(),
+                "synced_index": self.synced_index, "segment": self.segment_number}
 
-    def __getitem__(self, key: int):
-        return self.entries[key]
+    def page(self, start: int, limit: int):
+        start = max(start, self.base_index)
+        return {"base_index": self.base_index, "size": self.size(), "start": start,
+                "entries": self[start: start + limit]}
 
     def __json__(self):
-        return {"entries": self.entries}
\ No newline at end of file
+        return {"base_index": self.base_index, "entries": self[self.base_index: self.size()]}
@@ -0,0 +1,25 @@
+import atexit
+import logging
+import os
+import queue
+from logging import config
+from logging.handlers import QueueHandler, QueueListener
+
+
+def configure(path: str, message_loggers: tuple[str, ...] = ()) -> QueueListener:
+    # Serving threads only format and enqueue records, a listener thread writes them to the real handlers
+    config.fileConfig(path, disable_existing_loggers=False)
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    # Message bodies are serialized only when LOG_MESSAGES is set
+    if os.getenv("LOG_MESSAGES"):
+        for name in message_loggers:
+            logging.getLogger(name).setLevel(logging.DEBUG)
+    return listener
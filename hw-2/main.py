@@ -1,82 +1,250 @@
+import asyncio
 import json
 import logging
-from logging import config
 import os
 import sys
 from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+import httpx
 import uvicorn
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, Response, PlainTextResponse
 
-from server import Server
-from models import RaftRequest, RaftResponse, Operation
+import logsetup
+from metrics import METRICS, TRACES
+from node import Node
+from server import (Server, LeadershipLost, ReadUnavailable, MembershipChangeInProgress, BatchTooLarge, FOLLOWER_READS,
+                    MAX_APPEND_SIZE, server_address)
+from models import RaftRequest, RaftResponse, Operation, RaftBatchRequest, RaftBatchResponse, MemberRequest
 
 
-server: Server
+# "redirect" answers non-leader requests with a redirect, "forward" proxies them to the leader
+CLIENT_MODE = os.getenv("RAFT_CLIENT_MODE", "redirect")
+LEADER_WAIT_TIMEOUT = 5
+FORWARD_TIMEOUT = 10
+FORWARDED_HEADER = "x-raft-forwarded"
+MAX_PAGE_SIZE = 1000
+
+logger = logging.getLogger("app")
+
+node: Node
+client: httpx.AsyncClient
 
 
 @asynccontextmanager
 async def lifespan(app):
-    global server
+    global node, client
     if len(sys.argv) < 2:
         raise RuntimeError("Not enough arguments\nUsage: python main.py <server_id>")
-    logging.info(f"Starting server with ID: {sys.argv[2]}")
-    server = Server(int(sys.argv[2]))
+    logger.info("Starting server with ID: %s", sys.argv[2])
+    node = Node(int(sys.argv[2]), os.getenv("PATH_TO_DATA_DIR"))
+    await node.start()
+    client = httpx.AsyncClient(timeout=FORWARD_TIMEOUT, limits=httpx.Limits(max_keepalive_connections=32))
     yield
+    await client.aclose()
+    node.stop()
     print("Shutdown")
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+async def route_to_leader(server: Server, request: Request) -> Optional[Response]:
+    # Requests arriving during an election wait for the new leader instead of being bounced
+    if server.leader_id is None:
+        try:
+            await asyncio.wait_for(server.waitLeader(), LEADER_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="No leader elected, retry the request")
+    if server.isLeader():
+        return None
+    url = f"http://localhost:3333{server.leader_id}{request.url.path}"
+    if CLIENT_MODE != "forward":
+        return RedirectResponse(f"{url}?{request.url.query}" if request.url.query else url)
+    if request.headers.get(FORWARDED_HEADER):
+        raise HTTPException(status_code=503, detail="Not a leader, retry the request")
+    logger.info("App: Forward %s request to leader %s", request.method, server.leader_id)
+    try:
+        response = await client.request(request.method, url, params=request.query_params, content=await request.body(),
+                                        headers={"content-type": request.headers.get("content-type", "application/json"),
+                                                 FORWARDED_HEADER: str(server.id)})
+    except httpx.HTTPError as exception:
+        logger.info("App: Forwarding to leader %s failed: %r", server.leader_id, exception)
+        raise HTTPException(status_code=503, detail="Leader unavailable, retry the request")
+    return Response(content=response.content, status_code=response.status_code,
+                    media_type=response.headers.get("content-type"))
+
+
 @app.get("/")
 async def root():
-    logging.info(f"App: Root access")
+    logger.info("App: Root access")
     return "I am alive!"
 
+def json_response(content) -> Response:
+    # Serialized once with the __json__ hooks, without a round trip through Python objects
+    return Response(json.dumps(content), media_type="application/json")
+
+def group_server(group: int) -> Server:
+    if not 0 <= group < len(node.groups):
+        raise HTTPException(status_code=404, detail=f"No raft group {group}")
+    return node.groups[group]
+
 @app.get("/view")
-async def root():
-    logging.info(f"App: View access")
-    return json.loads(json.dumps(server, indent=4))
+async def view():
+    logger.info("App: View access")
+    return json_response(node.summary())
+
+@app.get("/view/log")
+async def view_log(group: int = 0, start: Optional[int] = None, limit: int = 100):
+    log = group_server(group).log
+    limit = min(max(limit, 0), MAX_PAGE_SIZE)
+    # Latest entries by default
+    return json_response(log.page(log.size() - limit if start is None else start, limit))
+
+@app.get("/view/storage")
+async def view_storage(group: int = 0, offset: int = 0, limit: int = 100):
+    return json_response(group_server(group).storage.page(max(offset, 0), min(max(limit, 0), MAX_PAGE_SIZE)))
+
+@app.get("/metrics")
+async def metrics():
+    node.updateMetrics()
+    return PlainTextResponse(METRICS.render())
+
+@app.get("/traces")
+async def traces():
+    return json_response(list(TRACES))
 
 @app.get("/storage")
-async def get_value(key: str):
-    logging.info(f"App: Got GET request for key: {key}")
-    if not server.isLeader():
-        return RedirectResponse(f"http://localhost:3333{server.leader_id}/storage")
-    result: int = server.serve_client(RaftRequest(key=key), Operation.GET)
+async def get_value(key: str, http_request: Request):
+    logger.info("App: Got GET request for key: %s", key)
+    server: Server = node.route(key)
+    if not server.isLeader() and FOLLOWER_READS != "off":
+        try:
+            return RaftResponse(value=await server.followerRead(key))
+        except ReadUnavailable:
+            logger.info("App: Follower read unavailable, route to leader")
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    try:
+        result: int = await server.read(key)
+    except LeadershipLost:
+        raise HTTPException(status_code=503, detail="Leadership lost, retry the request")
     return RaftResponse(value=result)
 
 @app.post("/storage")
-async def add_value(request: RaftRequest):
-    logging.info(f"App: Got request: {request}")
-    if not server.isLeader():
-        return RedirectResponse(f"http://localhost:3333{server.leader_id}/storage")
-    _: int = server.serve_client(request, Operation.POST)
+async def add_value(request: RaftRequest, http_request: Request):
+    logger.info("App: Got request: %s", request)
+    server: Server = node.route(request.key)
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    try:
+        _: int = await server.serve_client(request, Operation.POST)
+    except LeadershipLost:
+        raise HTTPException(status_code=503, detail="Leadership lost, retry the request")
     return RaftResponse(value="OK")
 
 @app.put("/storage")
-async def set_value(request: RaftRequest):
-    logging.info(f"App: Got request: {request}")
-    if not server.isLeader():
-        return RedirectResponse(f"http://localhost:3333{server.leader_id}/storage")
-    _: int = server.serve_client(request, Operation.PUT)
+async def set_value(request: RaftRequest, http_request: Request):
+    logger.info("App: Got request: %s", request)
+    server: Server = node.route(request.key)
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    try:
+        _: int = await server.serve_client(request, Operation.PUT)
+    except LeadershipLost:
+        raise HTTPException(status_code=503, detail="Leadership lost, retry the request")
     return RaftResponse(value="OK")
 
 @app.delete("/storage")
-async def delete_value(request: RaftRequest):
-    logging.info(f"App: Got request: {request}")
-    if not server.isLeader():
-        return RedirectResponse(f"http://localhost:3333{server.leader_id}/storage")
-    _: int = server.serve_client(request, Operation.DELETE)
+async def delete_value(request: RaftRequest, http_request: Request):
+    logger.info("App: Got request: %s", request)
+    server: Server = node.route(request.key)
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    try:
+        _: int = await server.serve_client(request, Operation.DELETE)
+    except LeadershipLost:
+        raise HTTPException(status_code=503, detail="Leadership lost, retry the request")
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Key not found")
     return RaftResponse(value="OK")
 
+@app.post("/storage/batch")
+async def batch(request: RaftBatchRequest, http_request: Request):
+    logger.info("App: Got batch of %s operations", len(request.operations))
+    if not request.operations:
+        return RaftBatchResponse(values=[])
+    shards: set[int] = {node.route(operation.key).group for operation in request.operations}
+    if len(shards) > 1:
+        raise HTTPException(status_code=400, detail="Batch spans several shards, split it by shard")
+    server: Server = node.route(request.operations[0].key)
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    try:
+        results: list[Optional[int]] = await server.serve_batch(request.operations)
+    except LeadershipLost:
+        raise HTTPException(status_code=503, detail="Leadership lost, retry the request")
+    except BatchTooLarge:
+        raise HTTPException(status_code=413, detail=f"Batch is over {MAX_APPEND_SIZE} bytes encoded, split it")
+    return RaftBatchResponse(values=[
+        result if operation.operation == Operation.GET else "OK"
+        for operation, result in zip(request.operations, results)
+    ])
+
+async def change_membership(change) -> RaftResponse:
+    try:
+        await change
+    except LeadershipLost:
+        raise HTTPException(status_code=503, detail="Leadership lost, retry the request")
+    except MembershipChangeInProgress:
+        raise HTTPException(status_code=409, detail="Another membership change is in progress, retry the request")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=409, detail="Learner did not catch up with the leader")
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Not a member")
+    except ValueError as exception:
+        raise HTTPException(status_code=400, detail=str(exception))
+    return RaftResponse(value="OK")
+
+@app.get("/membership")
+async def membership(group: int = 0):
+    server: Server = group_server(group)
+    return json_response({"configuration": server.configuration, "config_index": server.config_index,
+                          "committed": server.config_index <= server.commit_index})
+
+@app.post("/membership/learners")
+async def add_learner(request: MemberRequest, http_request: Request, group: int = 0):
+    logger.info("App: Add learner %s to group %s", request.id, group)
+    server: Server = group_server(group)
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    host, port = server_address(request.id)
+    return await change_membership(server.addLearner(request.id, (request.host or host, request.port or port)))
+
+@app.post("/membership/voters")
+async def promote(request: MemberRequest, http_request: Request, group: int = 0):
+    logger.info("App: Promote learner %s of group %s", request.id, group)
+    server: Server = group_server(group)
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    return await change_membership(server.promote(request.id))
+
+@app.delete("/membership")
+async def remove_member(request: MemberRequest, http_request: Request, group: int = 0):
+    logger.info("App: Remove member %s from group %s", request.id, group)
+    server: Server = group_server(group)
+    if not server.isLeader() and (response := await route_to_leader(server, http_request)) is not None:
+        return response
+    return await change_membership(server.removeMember(request.id))
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
         raise RuntimeError("Not enough arguments\nUsage: python main.py <port> <server_id>")
     os.environ["PATH_TO_LOG_FILE"] = f"server_{sys.argv[2]}.log"
-    logging.config.fileConfig("logging.conf")
-    logging.info(f"Starting FastAPI server at: {sys.argv[1]}")
-    uvicorn.run(app, host="0.0.0.0", port=int(sys.argv[1]), log_config="logging.conf", log_level="info")
+    os.environ["PATH_TO_DATA_DIR"] = f"server_{sys.argv[2]}_data"
+    logsetup.configure("logging.conf", ("raft.rpc",))
+    logger.info("Starting FastAPI server at: %s", sys.argv[1])
+    # Logging is already configured, uvicorn loggers propagate to the queue
+    uvicorn.run(app, host="0.0.0.0", port=int(sys.argv[1]), log_config=None, log_level="info")
@@ -0,0 +1,50 @@
+import json
+from typing import Optional
+
+
+class Configuration:
+    def __init__(self, voters: dict[int, tuple[str, int]], learners: Optional[dict[int, tuple[str, int]]] = None,
+                 old_voters: Optional[dict[int, tuple[str, int]]] = None) -> None:
+        self.voters: dict[int, tuple[str, int]] = voters
+        # Learners get the log but neither vote nor count towards any quorum
+        self.learners: dict[int, tuple[str, int]] = learners or {}
+        # Voters of the previous configuration while the cluster moves through joint consensus
+        self.old_voters: Optional[dict[int, tuple[str, int]]] = old_voters
+
+    @property
+    def joint(self) -> bool:
+        return self.old_voters is not None
+
+    @property
+    def voting_members(self) -> dict[int, tuple[str, int]]:
+        return {**(self.old_voters or {}), **self.voters}
+
+    @property
+    def members(self) -> dict[int, tuple[str, int]]:
+        return {**self.learners, **self.voting_members}
+
+    def quorums(self) -> list[dict[int, tuple[str, int]]]:
+        # Joint configuration needs separate majorities of the old and the new voters
+        return [self.voters, self.old_voters] if self.joint else [self.voters]
+
+    def has_quorum(self, ids: set[int]) -> bool:
+        return all(len(ids & voters.keys()) > len(voters) // 2 for voters in self.quorums())
+
+    def agreed(self, values: dict[int, int]) -> int:
+        # Highest value reached by a majority of every voter set
+        return min(sorted((values.get(id_, 0) for id_ in voters), reverse=True)[len(voters) // 2]
+                   for voters in self.quorums())
+
+    def dumps(self) -> str:
+        return json.dumps(self.__json__())
+
+    @staticmethod
+    def loads(data: str) -> "Configuration":
+        def members(encoded):
+            return None if encoded is None else {int(id_): tuple(address) for id_, address in encoded.items()}
+
+        data = json.loads(data)
+        return Configuration(members(data["voters"]), members(data["learners"]), members(data["old_voters"]))
+
+    def __json__(self):
+        return {"voters": self.voters, "learners": self.learners, "old_voters": self.old_voters}
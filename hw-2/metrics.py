@@ -0,0 +1,104 @@
+import bisect
+import os
+import random
+from collections import deque
+from typing import Optional
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Share of client requests traced through every stage, 0 turns tracing off
+TRACE_SAMPLE_RATE = float(os.getenv("RAFT_TRACE_SAMPLE_RATE", "0"))
+TRACES_KEPT = 256
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value: float = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self) -> None:
+        self.value: float = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float, count: int = 1) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.metrics: dict[str, tuple[str, dict[tuple, Counter | Gauge | Histogram]]] = {}
+
+    def get(self, kind, name: str, labels: dict[str, str]):
+        _, series = self.metrics.setdefault(name, (kind.__name__.lower(), {}))
+        key = tuple(labels.items())
+        metric = series.get(key)
+        if metric is None:
+            metric = series[key] = kind()
+        return metric
+
+    def counter(self, name: str, **labels) -> Counter:
+        return self.get(Counter, name, labels)
+
+    def gauge(self, name: str, **labels) -> Gauge:
+        return self.get(Gauge, name, labels)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        return self.get(Histogram, name, labels)
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines: list[str] = []
+        for name, (kind, series) in sorted(self.metrics.items()):
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in series.items():
+                labels = ",".join(f'{label}="{value}"' for label, value in key)
+                braced = f"{{{labels}}}" if labels else ""
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), metric.counts):
+                        cumulative += count
+                        bucket = ",".join(filter(None, [labels, f'le="{"+Inf" if bound == float("inf") else bound}"']))
+                        lines.append(f"{name}_bucket{{{bucket}}} {cumulative}")
+                    lines.append(f"{name}_sum{braced} {metric.sum}")
+                    lines.append(f"{name}_count{braced} {metric.count}")
+                else:
+                    lines.append(f"{name}{braced} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    def __init__(self, group: int, started: float) -> None:
+        self.group: int = group
+        self.index: Optional[int] = None
+        self.stages: list[tuple[str, float]] = [("submitted", started)]
+
+    def mark(self, stage: str, time: float) -> None:
+        self.stages.append((stage, time))
+
+    def __json__(self):
+        start = self.stages[0][1]
+        return {"group": self.group, "index": self.index,
+                "stages": {stage: round((time - start) * 1000, 3) for stage, time in self.stages}}
+
+
+def sampled() -> bool:
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+
+METRICS = Metrics()
+TRACES: deque[Trace] = deque(maxlen=TRACES_KEPT)
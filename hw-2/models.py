@@ -1,6 +1,21 @@
 from enum import IntEnum
-from typing import Optional
-from pydantic import BaseModel
+from typing import Annotated, Optional
+from pydantic import AfterValidator, BaseModel, Field
+
+from log import MIN_VALUE, MAX_VALUE
+
+# Keys are replicated inside Raft entries, which have to fit in a datagram
+MAX_KEY_SIZE = 1024
+
+
+def check_key(key: str) -> str:
+    if len(key.encode('utf-8')) > MAX_KEY_SIZE:
+        raise ValueError(f"Key is longer than {MAX_KEY_SIZE} bytes")
+    return key
+
+
+Key = Annotated[str, AfterValidator(check_key)]
+Value = Annotated[int, Field(ge=MIN_VALUE, le=MAX_VALUE)]
 
 
 class Operation(IntEnum):
@@ -11,9 +26,30 @@ class Operation(IntEnum):
 
 
 class RaftRequest(BaseModel):
-    key: Optional[str] = None
-    value: Optional[int] = None
+    key: Optional[Key] = None
+    value: Optional[Value] = None
 
 
 class RaftResponse(BaseModel):
-    value: Optional[int | str] = None
\ No newline at end of file
+    value: Optional[int | str] = None
+
+
+class BatchOperation(BaseModel):
+    operation: Operation
+    key: Key
+    value: Optional[Value] = None
+
+
+class RaftBatchRequest(BaseModel):
+    operations: list[BatchOperation]
+
+
+class RaftBatchResponse(BaseModel):
+    values: list[Optional[int | str]]
+
+
+class MemberRequest(BaseModel):
+    id: int
+    # Address of the raft endpoint, by default derived from the id like for the initial servers
+    host: Optional[str] = None
+    port: Optional[int] = None
\ No newline at end of file
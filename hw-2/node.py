@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import zlib
+from typing import Optional
+
+from codec import CODECS, FRAME, BATCH, pack_batch, unpack_batch
+from metrics import METRICS
+from rpc import RPC
+from server import Server, HEARTBEAT_TIMEOUT, server_address
+from timer import Timer
+
+logger = logging.getLogger("raft.node")
+
+WIRE_CODEC = os.getenv("RAFT_WIRE_CODEC", "binary")
+# Key space is split between this many independent Raft groups hosted by every node
+GROUPS = int(os.getenv("RAFT_GROUPS", "1"))
+# Below the 65507 bytes UDP allows, a single message over it cannot be sent at all
+MAX_DATAGRAM_SIZE = 60000
+
+
+class RaftProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node) -> None:
+        self.node = node
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]) -> None:
+        try:
+            self.node.receive(data)
+        except BaseException as exception:
+            logger.exception(exception)
+
+    def error_received(self, exception: Exception) -> None:
+        logger.error("Transport error: %s", exception)
+
+
+class Node:
+    def __init__(self, id_: int, data_dir: Optional[str] = None, groups: int = GROUPS) -> None:
+        self.address: tuple[str, int] = server_address(id_)
+        self.id: int = id_
+        self.loop = asyncio.get_running_loop()
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.codec = CODECS[WIRE_CODEC]
+        self.groups: list[Server] = [
+            Server(id_, group, self, os.path.join(data_dir, f"group_{group}") if data_dir else None)
+            for group in range(groups)
+        ]
+        self.outgoing: dict[tuple[str, int], list[bytes]] = {}
+        self.flush_scheduled: bool = False
+        # One timer drives the heartbeats of all groups, so they leave in the same datagram per peer
+        self.heartbeat_timer: Timer = Timer('Heartbeat', HEARTBEAT_TIMEOUT, self.heartbeat, False)
+
+    async def start(self, transport=None) -> None:
+        # Any object with sendto() and close() can stand in for the UDP endpoint, e.g. an in-memory network
+        if transport is None:
+            transport, _ = await self.loop.create_datagram_endpoint(lambda: RaftProtocol(self),
+                                                                    local_addr=self.address, reuse_port=True)
+        self.transport = transport
+        for server in self.groups:
+            server.start()
+        self.heartbeat_timer.start()
+        logger.info("Node started at %s with %s raft groups", self.address, len(self.groups))
+
+    def stop(self) -> None:
+        self.heartbeat_timer.cancel()
+        for server in self.groups:
+            server.stop()
+        if self.transport:
+            self.transport.close()
+
+    def route(self, key: Optional[str]) -> Server:
+        return self.groups[zlib.crc32((key or "").encode('utf-8')) % len(self.groups)]
+
+    def heartbeat(self) -> None:
+        for server in self.groups:
+            if server.isLeader():
+                server.heartbeatRepair()
+
+    def send(self, address: tuple[str, int], message: RPC) -> None:
+        # Messages of all groups to the same peer are batched until the end of the loop iteration
+        self.outgoing.setdefault(address, []).append(self.codec.encode(message))
+        METRICS.counter("raft_rpc_sent_total", type=message.message_type.value).inc()
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self) -> None:
+        self.flush_scheduled = False
+        outgoing, self.outgoing = self.outgoing, {}
+        for address, messages in outgoing.items():
+            batch: list[bytes] = []
+            size: int = BATCH.size
+            for message in messages:
+                if batch and size + FRAME.size + len(message) > MAX_DATAGRAM_SIZE:
+                    self.sendDatagram(pack_batch(batch), address)
+                    batch, size = [], BATCH.size
+                batch.append(message)
+                size += FRAME.size + len(message)
+            self.sendDatagram(pack_batch(batch), address)
+
+    def sendDatagram(self, data: bytes, address: tuple[str, int]) -> None:
+        METRICS.counter("raft_datagrams_sent_total").inc()
+        METRICS.counter("raft_bytes_sent_total").inc(len(data))
+        self.transport.sendto(data, address)
+
+    def receive(self, data: bytes) -> None:
+        METRICS.counter("raft_datagrams_received_total").inc()
+        METRICS.counter("raft_bytes_received_total").inc(len(data))
+        for message in unpack_batch(data):
+            # Frames are sized, a message that fails to decode or apply does not cost the rest of the datagram
+            try:
+                rpc: RPC = self.codec.decode(message)
+                METRICS.counter("raft_rpc_received_total", type=rpc.message_type.value).inc()
+                if rpc.group >= len(self.groups):
+                    logger.info("Unknown raft group %s, ignore", rpc.group)
+                    continue
+                self.groups[rpc.group].receive(rpc)
+            except BaseException as exception:
+                logger.exception(exception)
+
+    def updateMetrics(self) -> None:
+        for server in self.groups:
+            server.updateMetrics()
+
+    def summary(self):
+        return {"address": self.address, "id": self.id, "groups": [server.summary() for server in self.groups]}
+
+    def __json__(self):
+        return {
+            "address": self.address,
+            "id": self.id,
+            "groups": self.groups,
+            "heartbeat_timer": self.heartbeat_timer
+        }
@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+from enum import Enum
+
+from dataclasses_json import dataclass_json
+
+from log import Entry
+
+
+@dataclass_json
+@dataclass
+class AppendEntry:
+    entries: list[Entry]
+    prev_entry_idx: int
+    prev_entry_term: int
+    commit_idx: int
+    read_round: int = 0
+
+    def __json__(self):
+        return {"entries": self.entries, "prev_entry_idx": self.prev_entry_idx, "prev_entry_term": self.prev_entry_term,
+                "commit_idx": self.commit_idx, "read_round": self.read_round}
+
+
+@dataclass_json
+@dataclass
+class AppendEntryResponse:
+    success: bool
+    last_entry_idx: int
+    conflict_term: int = -1
+    conflict_idx: int = 0
+    read_round: int = 0
+    # Entries the request carried, answers to empty appends take no place in the pipeline
+    entry_count: int = 0
+
+    def __json__(self):
+        return {"success": self.success, "last_entry_idx": self.last_entry_idx, "conflict_term": self.conflict_term,
+                "conflict_idx": self.conflict_idx, "read_round": self.read_round, "entry_count": self.entry_count}
+
+
+@dataclass_json
+@dataclass
+class RequestVote:
+    last_entry_idx: int
+    last_entry_term: int
+
+    def __json__(self):
+        return {"last_entry_idx": self.last_entry_idx, "last_entry_term": self.last_entry_term}
+
+
+@dataclass_json
+@dataclass
+class RequestVoteResponse:
+    vote_granted: bool
+
+    def __json__(self):
+        return {"vote_granted": self.vote_granted}
+
+
+@dataclass_json
+@dataclass
+class InstallSnapshot:
+    last_included_idx: int
+    last_included_term: int
+    offset: int
+    data: str
+    done: bool
+    # Configuration covered by the snapshot, empty for the initial one
+    configuration: str = ""
+
+    def __json__(self):
+        return {"last_included_idx": self.last_included_idx, "last_included_term": self.last_included_term,
+                "offset": self.offset, "data": self.data, "done": self.done, "configuration": self.configuration}
+
+
+@dataclass_json
+@dataclass
+class InstallSnapshotResponse:
+    last_included_idx: int
+    offset: int
+    done: bool
+
+    def __json__(self):
+        return {"last_included_idx": self.last_included_idx, "offset": self.offset, "done": self.done}
+
+
+@dataclass_json
+@dataclass
+class ReadIndex:
+    request_id: int
+
+    def __json__(self):
+        return {"request_id": self.request_id}
+
+
+@dataclass_json
+@dataclass
+class ReadIndexResponse:
+    request_id: int
+    read_index: int
+
+    def __json__(self):
+        return {"request_id": self.request_id, "read_index": self.read_index}
+
+
+class MessageType(str, Enum):
+    APPEND_ENTRY = "appendEntry"
+    APPEND_ENTRY_RESPONSE = "appendEntryResponse"
+    REQUEST_VOTE = "requestVote"
+    REQUEST_VOTE_RESPONSE = "requestVoteResponse"
+    INSTALL_SNAPSHOT = "installSnapshot"
+    INSTALL_SNAPSHOT_RESPONSE = "installSnapshotResponse"
+    READ_INDEX = "readIndex"
+    READ_INDEX_RESPONSE = "readIndexResponse"
+
+
+@dataclass_json
+@dataclass
+class RPC:
+    sender: int
+    term: int
+    message_type: MessageType
+    message: (AppendEntry | AppendEntryResponse | RequestVote | RequestVoteResponse | InstallSnapshot |
+              InstallSnapshotResponse | ReadIndexResponse | ReadIndex)
+    group: int = 0
+
+    def __json__(self):
+        return {"sender": self.sender, "term": self.term, "message_type": self.message_type, "message": self.message,
+                "group": self.group}
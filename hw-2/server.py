@@ -1,7 +1,8 @@
+import asyncio
+import heapq
 import random
-import threading
-from time import sleep
-from typing import Optional
+from collections import deque
+from typing import Iterator, Optional
 
 
 def _default(self, obj):
@@ -13,21 +14,51 @@ from json import JSONEncoder
 _default.default = JSONEncoder().default
 JSONEncoder.default = _default
 
-import json
 import logging
-import socket
-from dataclasses import dataclass
-from enum import IntEnum, Enum
-from threading import Thread
-from dataclasses_json import dataclass_json
+import os
+from enum import IntEnum
 
 from timer import Timer
 from storage import Storage
-from log import Log, Entry, Event
-from models import RaftRequest, Operation
+from log import Log, Entry, Event, entry_size, check_entry
+from models import RaftRequest, Operation, BatchOperation
+from metrics import METRICS, TRACES, Trace, sampled
+from membership import Configuration
+
+logger = logging.getLogger("raft")
+# Message bodies are logged at DEBUG only, they cost a full repr of every RPC
+rpc_logger = logging.getLogger("raft.rpc")
+from rpc import (AppendEntry, AppendEntryResponse, RequestVote, RequestVoteResponse, InstallSnapshot,
+                 InstallSnapshotResponse, ReadIndex, ReadIndexResponse, MessageType, RPC)
 
 HEARTBEAT_TIMEOUT = 10
-ELECTION_TIMEOUT = 15 + random.randint(0, 100) / 10
+MIN_ELECTION_TIMEOUT = 15
+ELECTION_TIMEOUT = MIN_ELECTION_TIMEOUT + random.randint(0, 100) / 10
+ELECTION_JITTER = MIN_ELECTION_TIMEOUT / 2
+# Leader keeps serving reads without a heartbeat quorum only for a margin below the shortest election timeout
+LEASE_TIMEOUT = MIN_ELECTION_TIMEOUT * 0.8
+READ_MODE = os.getenv("RAFT_READ_MODE", "read_index")
+# Reads on followers: "off" redirects them to the leader, "read_index" asks the leader for its commit index,
+# "stale" serves local state while the leader was heard within MAX_STALENESS seconds
+FOLLOWER_READS = os.getenv("RAFT_FOLLOWER_READS", "off")
+MAX_STALENESS = float(os.getenv("RAFT_MAX_STALENESS", "15"))
+READ_INDEX_TIMEOUT = 1
+MAX_ENTRIES_PER_APPEND = 64
+# Encoded entries of one AppendEntry, well below the datagram limit so the message is never cut
+MAX_APPEND_SIZE = 48 * 1024
+MAX_INFLIGHT_APPENDS = 4
+GROUP_COMMIT_WINDOW = 0.005
+GROUP_COMMIT_SIZE = 64
+# Log is compacted once its entries outgrow the snapshot, so a large storage is serialized in proportion to the
+# writes it takes and not every fixed number of entries
+SNAPSHOT_MIN_LOG_SIZE = 64 * 1024
+SNAPSHOT_LOG_RATIO = 1
+SNAPSHOT_CHUNK_SIZE = 8192
+# Apply stage hands control back to the event loop after this many entries
+APPLY_BATCH_SIZE = 256
+# Learner is promoted once it is at most this many entries behind the leader
+CATCH_UP_LAG = MAX_ENTRIES_PER_APPEND
+CATCH_UP_TIMEOUT = 60
 
 SERVERS = {
     2: ("127.0.0.2", 32000),
@@ -37,312 +68,892 @@ SERVERS = {
 }
 
 
-class State(IntEnum):
-    FOLLOWER = 0
-    CANDIDATE = 1
-    LEADER = 2
-
-
-@dataclass_json
-@dataclass
-class AppendEntry:
-    entry: Optional[Entry]
-    prev_entry_idx: int
-    prev_entry_term: int
-    commit_idx: int
-
-    def __json__(self):
-        return {"entry": self.entry, "prev_entry_idx": self.prev_entry_idx, "prev_entry_term": self.prev_entry_term,
-                "commit_idx": self.commit_idx}
-
-
-@dataclass_json
-@dataclass
-class AppendEntryResponse:
-    success: bool
-
-    def __json__(self):
-        return {"success": self.success}
-
+def server_address(id_: int) -> tuple[str, int]:
+    # Servers missing from the initial configuration follow the same addressing scheme
+    return SERVERS.get(id_, (f"127.0.0.{id_}", 32000))
 
-@dataclass_json
-@dataclass
-class RequestVote:
-    last_entry_idx: int
-    last_entry_term: int
 
-    def __json__(self):
-        return {"last_entry_idx": self.last_entry_idx, "last_entry_term": self.last_entry_term}
+class LeadershipLost(Exception):
+    pass
 
 
-@dataclass_json
-@dataclass
-class RequestVoteResponse:
-    vote_granted: bool
+class ReadUnavailable(Exception):
+    pass
 
-    def __json__(self):
-        return {"vote_granted": self.vote_granted}
 
+class MembershipChangeInProgress(Exception):
+    pass
 
-class MessageType(str, Enum):
-    APPEND_ENTRY = "appendEntry"
-    APPEND_ENTRY_RESPONSE = "appendEntryResponse"
-    REQUEST_VOTE = "requestVote"
-    REQUEST_VOTE_RESPONSE = "requestVoteResponse"
 
+class BatchTooLarge(Exception):
+    pass
 
-@dataclass_json
-@dataclass
-class RPC:
-    sender: int
-    term: int
-    message_type: MessageType
-    message: AppendEntry | AppendEntryResponse | RequestVote | RequestVoteResponse
 
-    def __json__(self):
-        return {"sender": self.sender, "term": self.term, "message_type": self.message_type, "message": self.message}
+class State(IntEnum):
+    FOLLOWER = 0
+    CANDIDATE = 1
+    LEADER = 2
 
 
 class Server:
-    def __init__(self, id_: int) -> None:
-        self.address: tuple[str, int] = SERVERS[id_]
+    def __init__(self, id_: int, group: int, node, data_dir: Optional[str] = None) -> None:
+        self.address: tuple[str, int] = server_address(id_)
         self.id: int = id_
+        self.group: int = group
+        self.node = node
+        self.loop = asyncio.get_running_loop()
 
         self.state: State = State.FOLLOWER
-        self.term: int = 0
-        self.log: Log = Log()
-        self.commit_index: int = 0
+        self.log: Log = Log(data_dir)
+        self.term: int = self.log.term
+        self.commit_index: int = self.log.base_index
+        self.last_applied: int = self.log.base_index
+        self.apply_event: asyncio.Event = asyncio.Event()
+        self.apply_task: Optional[asyncio.Task] = None
+        self.snapshot_task: Optional[asyncio.Task] = None
         self.storage: Storage = Storage()
+        if self.log.snapshot is not None:
+            self.storage.loads(self.log.snapshot)
+        self.snapshot_chunks: list[str] = []
+        self.snapshot_index: int = 0
+        self.snapshot_sender: Optional[int] = None
         self.leader_id: int = None
 
-        self.voted_for: int = None
+        self.voted_for: int = self.log.voted_for
         self.approves: set[int] = set()
-        self.election_timer: Timer = Timer('Election', ELECTION_TIMEOUT, self.startElection)
+        # Groups besides the first draw their own timeout, so their leaders spread over the nodes
+        election_timeout = ELECTION_TIMEOUT if group == 0 else ELECTION_TIMEOUT + random.uniform(0, ELECTION_JITTER)
+        self.election_timer: Timer = Timer('Election', election_timeout, self.startElection, False)
 
         self.next_index: dict[int, int] = {}
         self.match_index: dict[int, int] = {}
-        self.heartbeat_timer: Timer = Timer('Heartbeat', HEARTBEAT_TIMEOUT, self.heartbeatRepair, False)
-        self.lock = threading.Lock()
-
-        Thread(target=self.poll_rpcs).start()
-
-        logging.info(f"Server started at {self.address}")
+        self.sent_index: dict[int, int] = {}
+        self.inflight: dict[int, int] = {}
+        # Snapshot index and offset every follower holds of a snapshot transfer in progress
+        self.snapshot_progress: dict[int, tuple[int, int]] = {}
+        self.client_entries: list[tuple[Entry, asyncio.Future, Optional[Trace]]] = []
+        # Last index, size and append time of every batch of client entries, and commit time of every commit advance
+        self.append_batches: deque[tuple[int, int, float]] = deque()
+        self.commit_times: deque[tuple[int, float]] = deque()
+        self.traces: dict[int, Trace] = {}
+        self.commit_waiters: dict[int, tuple[int, asyncio.Future]] = {}
+        self.group_commit_timer: Timer = Timer('Group commit', GROUP_COMMIT_WINDOW, self.flushClientEntries, False, False)
+        self.outbox: list[tuple[tuple[str, int], RPC]] = []
+        self.sync_scheduled: bool = False
+
+        self.apply_waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.term_start_index: int = 0
+        self.term_start_waiters: list[asyncio.Future] = []
+        self.last_heartbeat: float = 0
+        self.read_round: int = 0
+        self.round_scheduled: bool = False
+        self.round_times: dict[int, float] = {}
+        self.acked_round: dict[int, int] = {}
+        self.confirmed_round: int = 0
+        self.read_waiters: list[tuple[int, asyncio.Future]] = []
+        self.lease_expiry: float = 0
+        self.read_requests: dict[int, asyncio.Future] = {}
+        self.read_request_id: int = 0
+        self.tasks: set[asyncio.Task] = set()
+        self.leader_waiters: list[asyncio.Future] = []
+
+        self.configuration: Configuration = Configuration(dict(SERVERS))
+        self.config_entry: tuple[int, Optional[str]] = (0, None)
+        self.config_index: int = 0
+        self.catch_up_waiters: dict[int, list[asyncio.Future]] = {}
+        self.updateConfiguration()
+
+    def start(self) -> None:
+        self.apply_task = self.loop.create_task(self.applyLoop())
+        self.election_timer.start()
+        logger.info("Raft group %s started at %s", self.group, self.address)
+
+    def stop(self) -> None:
+        if self.apply_task:
+            self.apply_task.cancel()
+        if self.snapshot_task:
+            self.snapshot_task.cancel()
+        self.election_timer.cancel()
+        self.group_commit_timer.cancel()
 
-    def broadcast(self, msg: bytes) -> None:
-        logging.info(f"BROADCAST -> {msg.decode('utf-8')}")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        for server_id, address in SERVERS.items():
+    def broadcast(self, message: RPC) -> None:
+        rpc_logger.debug("BROADCAST -> %s", message)
+        message.group = self.group
+        for server_id, address in self.configuration.voting_members.items():
             if server_id == self.id:
                 continue
-            n = sock.sendto(msg, address)
-            if n != len(msg):
-                logging.critical(f"Datagram split: {n} sent instead of {len(msg)}")
+            self.node.send(address, message)
 
-    @staticmethod
-    def sendTo(address: tuple[str, int], msg: bytes) -> None:
-        logging.info(f"SEND -> {msg.decode('utf-8')}")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        n = sock.sendto(msg, address)
-        if n != len(msg):
-            logging.critical(f"Datagram split: {n} sent instead of {len(msg)}")
-
-    def fallback(self, term: int, leader_id: int) -> None:
+    def addressOf(self, server_id: int) -> tuple[str, int]:
+        return self.configuration.members.get(server_id) or server_address(server_id)
+
+    def sendTo(self, address: tuple[str, int], message: RPC) -> None:
+        rpc_logger.debug("SEND -> %s", message)
+        message.group = self.group
+        self.node.send(address, message)
+
+    def fallback(self, term: int, leader_id: Optional[int], keep_timer: bool = False) -> None:
+        was_leader: bool = self.state == State.LEADER
+        if term != self.term:
+            METRICS.counter("raft_term_changes_total", group=str(self.group)).inc()
         self.state = State.FOLLOWER
         self.leader_id = leader_id
         self.term = term
         self.voted_for = None
+        self.log.save_state(self.term, self.voted_for)
+
+        for _, future, _ in self.client_entries:
+            self.completeWaiter(future, LeadershipLost(), None)
+        self.client_entries = []
+        self.append_batches.clear()
+        for _, future in self.read_waiters:
+            self.completeWaiter(future, LeadershipLost(), None)
+        self.read_waiters = []
+        for future in self.term_start_waiters:
+            self.completeWaiter(future, LeadershipLost(), None)
+        self.term_start_waiters = []
+        self.lease_expiry = 0
+        for future in self.read_requests.values():
+            self.completeWaiter(future, ReadUnavailable(), None)
+        self.read_requests = {}
+
+        if not keep_timer or was_leader:
+            self.election_timer.restart()
+        self.group_commit_timer.cancel()
+
+    def persist(self) -> None:
+        if not self.sync_scheduled:
+            self.sync_scheduled = True
+            self.loop.call_soon(self.syncLog)
+
+    def sendAfterSync(self, address: tuple[str, int], message: RPC) -> None:
+        self.outbox += [(address, message)]
+        self.persist()
+
+    def syncLog(self) -> None:
+        # Everything appended during this loop iteration shares one fsync before it is acknowledged
+        self.sync_scheduled = False
+        self.log.sync()
+        if self.traces:
+            self.markTraces("synced", self.log.synced_index)
+        outbox, self.outbox = self.outbox, []
+        for address, message in outbox:
+            self.sendTo(address, message)
+        if self.state == State.LEADER:
+            self.commitEntries()
 
-        self.election_timer.restart()
-        self.heartbeat_timer.cancel()
+    def receive(self, rpc: RPC) -> None:
+        rpc_logger.debug("RECEIVE <- %s", rpc)
 
-    def poll_rpcs(self):
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            sock.bind(self.address)
-            sock.settimeout(1)
-            while True:
-                try:
-                    message, address = sock.recvfrom(4096)
-                except socket.timeout:
-                    logging.info("")
-                    continue
-                self.election_timer.restart()
-                logging.info(f"RECEIVE <- {message.decode('utf-8')}")
-                rpc: RPC = RPC.from_json(message)
-
-                if rpc.sender == self.id or rpc.term < self.term:
-                    logging.info(f"Old term ({rpc.term} < {self.term}), ignore")
-                    continue
-                self.__getattribute__(rpc.message_type)(rpc.message, rpc.sender, rpc.term)
-        except BaseException as exception:
-            logging.exception(exception)
+        if rpc.sender == self.id or rpc.term < self.term:
+            logger.debug("Old term (%s < %s), ignore", rpc.term, self.term)
+            return
+        self.__getattribute__(rpc.message_type)(rpc.message, rpc.sender, rpc.term)
 
     def isLeader(self):
         return self.state == State.LEADER
 
-    def serve_client(self, request: RaftRequest, operation) -> Optional[int]:
-        entry: Entry = Entry(self.term, Event(operation), request.key, request.value)
-        with self.lock:
-            log_size: int = self.log.size()
-            res = self.log.add_entry(entry, log_size - 1, self.log[log_size - 1].term)
-            if not res:
-                logging.critical(f"Failed to add entry: {entry}")
-            message = RPC(self.id, self.term, MessageType.APPEND_ENTRY,
-                          AppendEntry(entry, log_size - 1, self.log[log_size - 1].term, self.commit_index))
-        self.broadcast(json.dumps(message).encode('utf-8'))
-        while self.commit_index < log_size:
-            sleep(1)
-        if operation == 1:
-            return self.log[log_size].value
+    def waitLeader(self) -> asyncio.Future:
+        future: asyncio.Future = self.loop.create_future()
+        if self.leader_id is not None:
+            future.set_result(self.leader_id)
+        else:
+            self.leader_waiters += [future]
+        return future
+
+    def wakeLeaderWaiters(self) -> None:
+        for future in self.leader_waiters:
+            self.completeWaiter(future, None, self.leader_id)
+        self.leader_waiters = []
+
+    async def serve_client(self, request: RaftRequest, operation) -> Optional[int]:
+        return await self.submit(Entry(self.term, Event(operation), request.key, request.value))
+
+    async def serve_batch(self, operations: list[BatchOperation]) -> list[Optional[int]]:
+        entry = Entry(self.term, Event.BATCH, operations=[
+            Entry(self.term, Event(operation.operation), operation.key, operation.value) for operation in operations
+        ])
+        # Batch is applied as one entry, which has to fit in one AppendEntry
+        if entry_size(entry) > MAX_APPEND_SIZE:
+            raise BatchTooLarge()
+        return await self.submit(entry)
+
+    async def submit(self, entry: Entry):
+        if not self.state == State.LEADER:
+            raise LeadershipLost()
+        # Refused before it joins a group commit, where it would fail the other entries
+        check_entry(entry)
+        future: asyncio.Future = self.loop.create_future()
+        self.client_entries += [(entry, future, Trace(self.group, self.loop.time()) if sampled() else None)]
+        if len(self.client_entries) >= GROUP_COMMIT_SIZE:
+            self.group_commit_timer.cancel()
+            self.flushClientEntries()
+        elif len(self.client_entries) == 1:
+            self.group_commit_timer.restart()
+        return await future
+
+    async def changeMembership(self, voters: dict[int, tuple[str, int]], learners: dict[int, tuple[str, int]]) -> None:
+        if not self.state == State.LEADER:
+            raise LeadershipLost()
+        if self.config_index > self.commit_index or self.configuration.joint:
+            raise MembershipChangeInProgress()
+        if not voters:
+            raise ValueError("Configuration needs at least one voter")
+        current: Configuration = self.configuration
+        # Learners do not take part in any quorum, only a change of voters needs joint consensus
+        old_voters = None if voters.keys() == current.voters.keys() else current.voters
+        future: asyncio.Future = self.loop.create_future()
+        configuration = Configuration(voters, learners, old_voters)
+        index: int = self.appendLeaderEntry(Entry(self.term, Event.CONFIG, configuration.dumps()))
+        self.commit_waiters[index] = (self.term, future)
+        await future
+        if old_voters is not None:
+            # Leader appends the new configuration as soon as the joint one is applied
+            await self.waitApplied(self.config_index)
+
+    async def addLearner(self, server_id: int, address: tuple[str, int]) -> None:
+        if server_id in self.configuration.members:
+            raise ValueError(f"Server {server_id} is already a member")
+        await self.changeMembership(self.configuration.voters, {**self.configuration.learners, server_id: address})
+
+    async def promote(self, server_id: int) -> None:
+        if server_id not in self.configuration.learners:
+            raise KeyError(server_id)
+        # Learner joins the quorum only with a log close to the leader's, so it does not stall commits
+        await asyncio.wait_for(self.waitCaughtUp(server_id), CATCH_UP_TIMEOUT)
+        learners = dict(self.configuration.learners)
+        await self.changeMembership({**self.configuration.voters, server_id: learners.pop(server_id)}, learners)
+
+    async def removeMember(self, server_id: int) -> None:
+        voters = dict(self.configuration.voters)
+        learners = dict(self.configuration.learners)
+        if voters.pop(server_id, None) is None and learners.pop(server_id, None) is None:
+            raise KeyError(server_id)
+        await self.changeMembership(voters, learners)
+
+    def waitCaughtUp(self, server_id: int) -> asyncio.Future:
+        future: asyncio.Future = self.loop.create_future()
+        self.catch_up_waiters.setdefault(server_id, []).append(future)
+        self.wakeCatchUpWaiters(server_id)
+        return future
+
+    def wakeCatchUpWaiters(self, server_id: int) -> None:
+        if server_id not in self.catch_up_waiters or self.state != State.LEADER:
+            return
+        if self.log.size() - 1 - self.match_index.get(server_id, 0) <= CATCH_UP_LAG:
+            for future in self.catch_up_waiters.pop(server_id):
+                self.completeWaiter(future, None, None)
+
+    async def read(self, key: str) -> Optional[int]:
+        read_index: int = await self.confirmReadIndex()
+        await self.waitApplied(read_index)
+        return self.storage.get(key)
+
+    async def confirmReadIndex(self) -> int:
+        if not self.state == State.LEADER:
+            raise LeadershipLost()
+        if self.log.term_at(self.commit_index) != self.term:
+            # Leader knows the latest commit index only once an entry of its own term is committed. After a step
+            # down that entry may never be applied, so stepping down fails the wait
+            future: asyncio.Future = self.waitApplied(self.term_start_index)
+            self.term_start_waiters = [waiter for waiter in self.term_start_waiters if not waiter.done()] + [future]
+            await future
+        read_index: int = self.commit_index
+        if not (READ_MODE == "lease" and self.loop.time() < self.lease_expiry):
+            await self.confirmLeadership()
+        return read_index
+
+    async def followerRead(self, key: str) -> Optional[int]:
+        if FOLLOWER_READS == "stale":
+            if self.loop.time() - self.last_heartbeat > MAX_STALENESS:
+                raise ReadUnavailable()
+            return self.storage.get(key)
+        if self.leader_id is None:
+            raise ReadUnavailable()
+        self.read_request_id += 1
+        request_id: int = self.read_request_id
+        future: asyncio.Future = self.loop.create_future()
+        self.read_requests[request_id] = future
+        self.sendTo(self.addressOf(self.leader_id), RPC(self.id, self.term, MessageType.READ_INDEX, ReadIndex(request_id)))
+        try:
+            read_index: int = await asyncio.wait_for(future, READ_INDEX_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ReadUnavailable()
+        finally:
+            self.read_requests.pop(request_id, None)
+        await self.waitApplied(read_index)
+        return self.storage.get(key)
+
+    def waitApplied(self, index: int) -> asyncio.Future:
+        future: asyncio.Future = self.loop.create_future()
+        if self.last_applied >= index:
+            future.set_result(None)
+        else:
+            heapq.heappush(self.apply_waiters, (index, id(future), future))
+        return future
+
+    def wakeApplyWaiters(self) -> None:
+        while self.apply_waiters and self.apply_waiters[0][0] <= self.last_applied:
+            self.completeWaiter(heapq.heappop(self.apply_waiters)[2], None, None)
+
+    def confirmLeadership(self) -> asyncio.Future:
+        # Reads waiting in the same loop iteration share the next read round
+        future: asyncio.Future = self.loop.create_future()
+        if not self.state == State.LEADER:
+            # No heartbeat round follows once the leader stepped down
+            future.set_exception(LeadershipLost())
+            return future
+        self.read_waiters += [(self.read_round + 1, future)]
+        if not self.round_scheduled:
+            self.round_scheduled = True
+            self.loop.call_soon(self.sendReadRound)
+        return future
+
+    def confirmRounds(self) -> None:
+        # The latest round acknowledged by a majority of servers
+        confirmed = self.configuration.agreed({**self.acked_round, self.id: self.read_round})
+        if confirmed <= self.confirmed_round:
+            return
+        self.confirmed_round = confirmed
+        self.lease_expiry = self.round_times[confirmed] + LEASE_TIMEOUT
+        self.round_times = {r: started for r, started in self.round_times.items() if r > confirmed}
+        waiting: list[tuple[int, asyncio.Future]] = []
+        for read_round, future in self.read_waiters:
+            if read_round <= confirmed:
+                self.completeWaiter(future, None, None)
+            else:
+                waiting += [(read_round, future)]
+        self.read_waiters = waiting
+
+    def flushClientEntries(self) -> None:
+        if not self.client_entries:
+            return
+        client_entries, self.client_entries = self.client_entries, []
+        entries: list[Entry] = [entry for entry, _, _ in client_entries]
+        log_size: int = self.log.size()
+        logger.debug("Group commit of %s client entries", len(entries))
+        res = self.log.add_entries(entries, log_size - 1, self.log.last_term())
+        if not res:
+            logger.critical("Failed to add entries: %s", entries)
+        self.updateConfiguration()
+        now: float = self.loop.time()
+        for index, (entry, future, trace) in enumerate(client_entries, log_size):
+            self.commit_waiters[index] = (entry.term, future)
+            if trace:
+                trace.index = index
+                trace.mark("appended", now)
+                self.traces[index] = trace
+        self.append_batches.append((log_size + len(entries) - 1, len(entries), now))
+        self.persist()
+        self.replicateAll()
+
+    def appendLeaderEntry(self, entry: Entry) -> int:
+        log_size: int = self.log.size()
+        res = self.log.add_entries([entry], log_size - 1, self.log.last_term())
+        if not res:
+            logger.critical("Failed to add entry: %s", entry)
+        self.updateConfiguration()
+        self.persist()
+        self.replicateAll()
+        return log_size
+
+    def commit(self, commit_index: int) -> None:
+        if commit_index > self.commit_index:
+            self.commit_index = commit_index
+            self.apply_event.set()
+            now: float = self.loop.time()
+            self.commit_times.append((commit_index, now))
+            while self.append_batches and self.append_batches[0][0] <= commit_index:
+                _, size, appended = self.append_batches.popleft()
+                METRICS.histogram("raft_append_commit_seconds", group=str(self.group)).observe(now - appended, size)
+            if self.traces:
+                self.markTraces("committed", commit_index)
+
+    async def applyLoop(self) -> None:
+        # Committed entries are applied apart from the RPC handlers, a large commit advance is applied in
+        # slices so votes and heartbeats are still handled in between
+        while True:
+            await self.apply_event.wait()
+            self.apply_event.clear()
+            while self.last_applied < self.commit_index:
+                self.applyEntries(min(self.commit_index, self.last_applied + APPLY_BATCH_SIZE))
+                await asyncio.sleep(0)
+
+    def applyEntries(self, last_index: int) -> None:
+        for index in range(self.last_applied + 1, last_index + 1):
+            entry: Entry = self.log[index]
+            error: Optional[Exception] = None
+            try:
+                result = self.storage.apply(entry)
+            except Exception as exception:
+                # Every replica fails the same way on the same entry, the state machine stays consistent
+                logger.exception(exception)
+                result, error = None, exception
+            waiter = self.commit_waiters.pop(index, None)
+            if waiter:
+                term, future = waiter
+                # Another leader could have overwritten the entry before it was committed
+                self.completeWaiter(future, error if entry.term == term else LeadershipLost(), result)
+        self.last_applied = last_index
+        self.wakeApplyWaiters()
+        now: float = self.loop.time()
+        while self.commit_times and self.commit_times[0][0] <= last_index:
+            METRICS.histogram("raft_commit_apply_seconds", group=str(self.group)).observe(
+                now - self.commit_times.popleft()[1])
+        if self.traces:
+            self.markTraces("applied", last_index)
+            for index in [index for index in self.traces.keys() if index <= last_index]:
+                TRACES.append(self.traces.pop(index))
+        if self.snapshot_task is None and self.log.encoded_size() >= max(
+                SNAPSHOT_MIN_LOG_SIZE, SNAPSHOT_LOG_RATIO * len(self.log.snapshot or "")):
+            self.snapshot_task = self.loop.create_task(self.takeSnapshot(
+                self.last_applied, self.log.term_at(self.last_applied), self.log.config_at(self.last_applied),
+                self.storage.snapshot()))
+        if self.state == State.LEADER and self.config_index <= self.last_applied:
+            if self.configuration.joint:
+                # Joint configuration is committed, so the new one can take over alone
+                self.appendLeaderEntry(Entry(self.term, Event.CONFIG, Configuration(
+                    self.configuration.voters, self.configuration.learners).dumps()))
+            elif self.id not in self.configuration.voters:
+                logger.info("Removed from the configuration, step down")
+                self.fallback(self.term, None)
+
+    async def takeSnapshot(self, index: int, term: int, config: Optional[str], slices: Iterator[str]) -> None:
+        # Storage copy is serialized slice by slice and written outside the loop, entries are applied and RPCs
+        # answered meanwhile
+        try:
+            parts: list[str] = []
+            for part in slices:
+                parts.append(part)
+                await asyncio.sleep(0)
+            data: str = "".join(parts)
+            path: Optional[str] = None
+            if self.log.path is not None:
+                path = await self.loop.run_in_executor(None, self.log.write_snapshot, index, term, config, data)
+            self.log.compact(index, data, path)
+        except Exception as exception:
+            logger.exception(exception)
+        finally:
+            self.snapshot_task = None
+
+    def markTraces(self, stage: str, index: int) -> None:
+        now: float = self.loop.time()
+        for trace in self.traces.values():
+            if trace.index <= index and trace.stages[-1][0] != stage:
+                trace.mark(stage, now)
+
+    def updateMetrics(self) -> None:
+        group = str(self.group)
+        METRICS.gauge("raft_term", group=group).set(self.term)
+        METRICS.gauge("raft_state", group=group).set(self.state)
+        METRICS.gauge("raft_commit_index", group=group).set(self.commit_index)
+        METRICS.gauge("raft_last_applied", group=group).set(self.last_applied)
+        METRICS.gauge("raft_log_entries", group=group).set(self.log.size() - self.log.base_index)
+        if self.state == State.LEADER:
+            last_index: int = self.log.size() - 1
+            for server_id in self.configuration.members.keys():
+                if server_id != self.id:
+                    METRICS.gauge("raft_match_lag", group=group, follower=str(server_id)).set(
+                        last_index - self.match_index[server_id])
+
+    @staticmethod
+    def completeWaiter(future: asyncio.Future, error: Optional[Exception], result: Optional[int]) -> None:
+        if future.done():
+            return
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
 
     def startElection(self) -> None:
         if self.state == State.LEADER:
-            logging.info(f"Already leader, do not start election")
+            logger.info("Already leader, do not start election")
             return
+        if self.id not in self.configuration.voting_members:
+            logger.debug("Not a voting member, do not start election")
+            return
+        METRICS.counter("raft_elections_started_total", group=str(self.group)).inc()
+        METRICS.counter("raft_term_changes_total", group=str(self.group)).inc()
         self.state = State.CANDIDATE
         self.term += 1
         self.voted_for = self.id
         self.approves = {self.id}
+        self.log.save_state(self.term, self.voted_for)
+        self.log.sync()
         log_size: int = self.log.size()
-        message = RPC(self.id, self.term, MessageType.REQUEST_VOTE, RequestVote(log_size - 1, self.log[log_size - 1].term))
-        self.broadcast(json.dumps(message).encode('utf-8'))
+        message = RPC(self.id, self.term, MessageType.REQUEST_VOTE, RequestVote(log_size - 1, self.log.last_term()))
+        self.broadcast(message)
+
+    def startRound(self) -> None:
+        self.read_round += 1
+        self.round_times[self.read_round] = self.loop.time()
+        self.confirmRounds()
+
+    def sendReadRound(self) -> None:
+        # Reads only need a majority of voters to answer, the batches in flight are left alone: one empty append
+        # per follower right after its last acknowledged entry
+        self.round_scheduled = False
+        if not self.state == State.LEADER:
+            return
+        self.startRound()
+        for server_id in self.configuration.voting_members:
+            prev_index = self.next_index[server_id] - 1
+            if server_id == self.id or prev_index < self.log.base_index:
+                # Followers receiving a snapshot answer the next heartbeat round
+                continue
+            message = RPC(self.id, self.term, MessageType.APPEND_ENTRY,
+                          AppendEntry([], prev_index, self.log.term_at(prev_index), self.commit_index, self.read_round))
+            METRICS.counter("raft_read_probes_total", group=str(self.group)).inc()
+            self.sendTo(self.addressOf(server_id), message)
 
     def heartbeatRepair(self) -> None:
         if not self.state == State.LEADER:
-            logging.info(f"Not a leader, heartbeat cancelled")
+            logger.info("Not a leader, heartbeat cancelled")
             return
-        for server_id, server in SERVERS.items():
+        self.startRound()
+        for server_id in self.configuration.members.keys():
             if server_id == self.id:
                 continue
-            index = self.next_index[server_id]
-            entry = None
-            if index < self.log.size():
-                entry = self.log[index]
-            message = RPC(self.id, self.term, MessageType.APPEND_ENTRY,
-                          AppendEntry(entry, index - 1, self.log[index - 1].term, self.commit_index))
-            self.sendTo(SERVERS[server_id], json.dumps(message).encode('utf-8'))
+            # Unacknowledged batches may have been lost, so restart the pipeline from the first unmatched entry
+            self.sent_index[server_id] = self.next_index[server_id]
+            self.inflight[server_id] = 0
+            self.sendAppendEntry(server_id)
+            self.replicate(server_id)
+
+    def sendAppendEntry(self, server_id: int) -> None:
+        index = self.sent_index[server_id]
+        if index <= self.log.base_index:
+            # Heartbeats resume a transfer in progress, a snapshot may take many of them to send
+            self.sendSnapshotChunk(server_id, self.snapshotOffset(server_id))
+            return
+        entries = self.log[index: index + MAX_ENTRIES_PER_APPEND]
+        size: int = 0
+        for count, entry in enumerate(entries):
+            size += entry_size(entry)
+            if count and size > MAX_APPEND_SIZE:
+                entries = entries[:count]
+                break
+        message = RPC(self.id, self.term, MessageType.APPEND_ENTRY,
+                      AppendEntry(entries, index - 1, self.log.term_at(index - 1), self.commit_index, self.read_round))
+        self.sent_index[server_id] = index + len(entries)
+        if entries:
+            self.inflight[server_id] += 1
+        METRICS.counter("raft_entries_sent_total", group=str(self.group)).inc(len(entries))
+        self.sendTo(self.addressOf(server_id), message)
+
+    def replicate(self, server_id: int) -> None:
+        # Pipeline batches only to replicas known to be in sync, probe the others one batch at a time
+        limit = 1
+        if self.match_index[server_id] + 1 == self.next_index[server_id] and self.sent_index[server_id] > self.log.base_index:
+            limit = MAX_INFLIGHT_APPENDS
+        while self.inflight[server_id] < limit and self.sent_index[server_id] < self.log.size():
+            self.sendAppendEntry(server_id)
+
+    def replicateAll(self) -> None:
+        for server_id in self.configuration.members.keys():
+            if server_id != self.id:
+                self.replicate(server_id)
 
     def requestVote(self, request: RequestVote, sender: int, term: int) -> None:
-        with self.lock:
-            message = RPC(self.id, self.term, MessageType.REQUEST_VOTE_RESPONSE, RequestVoteResponse(False))
-            if term > self.term:
-                logging.info(f"New term ({term} > {self.term}), fallback to follower")
-                self.fallback(term, sender)
-
-            if (term >= self.term and
-                    (request.last_entry_term > self.log[-1].term or
-                     request.last_entry_term == self.log[-1].term and request.last_entry_idx >= self.log.size() - 1) and
-                    self.voted_for is None):
-                logging.info(f"Voting for {sender} to become new leader")
-                self.voted_for = sender
-                message = RPC(self.id, self.term, MessageType.REQUEST_VOTE_RESPONSE, RequestVoteResponse(True))
-
-        self.sendTo(SERVERS[sender], json.dumps(message).encode('utf-8'))
+        message = RPC(self.id, self.term, MessageType.REQUEST_VOTE_RESPONSE, RequestVoteResponse(False))
+        leader_alive = (self.state == State.LEADER or self.state == State.FOLLOWER and sender != self.leader_id and
+                        self.loop.time() - self.last_heartbeat < MIN_ELECTION_TIMEOUT)
+        if leader_alive and (READ_MODE == "lease" and self.state == State.FOLLOWER or
+                             sender not in self.configuration.voting_members):
+            # Current leader may still hold a read lease, do not help to replace it until the lease could expire.
+            # Servers removed from the configuration are not heard either, they would only disrupt the cluster
+            logger.info("Heard from leader %s recently, ignore vote request from %s", self.leader_id, sender)
+            self.sendTo(self.addressOf(sender), message)
+            return
+        if term > self.term:
+            logger.info("New term (%s > %s), fallback to follower", term, self.term)
+            # A vote request is no sign of a live leader: keep the election timer running, otherwise a candidate
+            # that can never win keeps the up-to-date servers from ever starting an election
+            self.fallback(term, None, keep_timer=True)
+
+        if (term >= self.term and
+                (request.last_entry_term > self.log.last_term() or
+                 request.last_entry_term == self.log.last_term() and request.last_entry_idx >= self.log.size() - 1) and
+                self.voted_for is None):
+            logger.info("Voting for %s to become new leader", sender)
+            self.voted_for = sender
+            self.log.save_state(self.term, self.voted_for)
+            self.election_timer.restart()
+            message = RPC(self.id, self.term, MessageType.REQUEST_VOTE_RESPONSE, RequestVoteResponse(True))
+
+        self.sendAfterSync(self.addressOf(sender), message)
 
     def requestVoteResponse(self, response: RequestVoteResponse, sender: int, term: int) -> None:
         if term > self.term:
-            logging.info(f"New term ({term} > {self.term}), fallback to follower")
+            logger.info("New term (%s > %s), fallback to follower", term, self.term)
             self.fallback(term, sender)
             return
         if not response.vote_granted or self.state != State.CANDIDATE:
             return
-        with self.lock:
-            self.approves.add(sender)
-            if len(self.approves) >= (len(SERVERS) + 1) / 2. and not self.state == State.LEADER:
-                self.transformToLeader()
-                logging.info(f"Selected as leader")
-                new_term_base_entry: Entry = Entry(self.term)
-                log_size: int = self.log.size()
-                res = self.log.add_entry(new_term_base_entry, log_size - 1, self.log[log_size - 1].term)
-                if not res:
-                    logging.critical(f"Failed to add entry: {new_term_base_entry}")
-                message = RPC(self.id, self.term, MessageType.APPEND_ENTRY,
-                              AppendEntry(new_term_base_entry, log_size - 1, self.log[log_size - 1].term, self.commit_index))
-                self.broadcast(json.dumps(message).encode('utf-8'))
+        self.approves.add(sender)
+        if self.configuration.has_quorum(self.approves) and not self.state == State.LEADER:
+            self.transformToLeader()
+            logger.info("Selected as leader")
+            self.term_start_index = self.appendLeaderEntry(Entry(self.term))
 
     def transformToLeader(self):
         self.state = State.LEADER
         self.leader_id = self.id
-        log_size: int = self.log.size()
-        self.next_index = {x: log_size for x in SERVERS.keys()}
-        self.match_index = {x: 0 for x in SERVERS.keys()}
+        self.next_index = {}
+        self.match_index = {}
+        self.sent_index = {}
+        self.inflight = {}
+        self.snapshot_progress = {}
+        self.read_round = 0
+        self.round_times = {}
+        self.acked_round = {}
+        self.confirmed_round = 0
+        self.trackMembers()
 
         self.election_timer.cancel()
-        self.heartbeat_timer.restart()
+        self.wakeLeaderWaiters()
 
-    def appendEntry(self, request: AppendEntry, sender: int, term: int) -> None:
-        if term > self.term:
-            logging.info(f"New term ({term} > {self.term}), fallback to follower")
+    def updateConfiguration(self) -> None:
+        # Servers act on the latest configuration in their log, whether it is committed or not
+        config_entry = self.log.configuration()
+        if config_entry == self.config_entry:
+            return
+        self.config_entry = config_entry
+        self.config_index, data = config_entry
+        self.configuration = Configuration.loads(data) if data else Configuration(dict(SERVERS))
+        logger.info("Configuration at %s: %s", self.config_index, self.configuration.dumps())
+        if self.state == State.LEADER:
+            self.trackMembers()
+
+    def trackMembers(self) -> None:
+        log_size: int = self.log.size()
+        members = self.configuration.members
+        for server_id in members.keys() - self.next_index.keys():
+            self.next_index[server_id] = log_size
+            self.match_index[server_id] = 0
+            self.sent_index[server_id] = log_size
+            self.inflight[server_id] = 0
+            self.acked_round[server_id] = 0
+        for server_id in self.next_index.keys() - members.keys() - {self.id}:
+            for progress in (self.next_index, self.match_index, self.sent_index, self.inflight, self.acked_round):
+                progress.pop(server_id)
+            self.snapshot_progress.pop(server_id, None)
+
+    def followLeader(self, sender: int, term: int) -> None:
+        if term > self.term or self.state == State.CANDIDATE:
+            logger.info("Leader of term %s is %s, fallback to follower", term, sender)
             self.fallback(term, sender)
+        else:
+            self.leader_id = sender
+            self.election_timer.restart()
+        self.last_heartbeat = self.loop.time()
+        self.wakeLeaderWaiters()
 
-        with self.lock:
-            result = self.log.add_entry(request.entry, request.prev_entry_idx, request.prev_entry_term)
-            if result:
-                message = RPC(self.id, self.term, MessageType.APPEND_ENTRY_RESPONSE, AppendEntryResponse(True))
-                if request.commit_idx > self.commit_index:
-                    newl = min(request.commit_idx, self.log.size() - 1)
-                    logging.info(f"Commiting entries from {self.commit_index + 1} to {newl}")
-                    for entry in self.log[self.commit_index + 1: newl + 1]:
-                        res = self.storage.apply(entry)
-                        if res:
-                            entry.value = res
-                    self.commit_index = newl
-            else:
-                message = RPC(self.id, self.term, MessageType.APPEND_ENTRY_RESPONSE, AppendEntryResponse(False))
-        self.sendTo(SERVERS[sender], json.dumps(message).encode('utf-8'))
+    def appendEntry(self, request: AppendEntry, sender: int, term: int) -> None:
+        self.followLeader(sender, term)
+        result = self.log.add_entries(request.entries, request.prev_entry_idx, request.prev_entry_term)
+        if result:
+            self.updateConfiguration()
+            if self.commit_waiters:
+                self.failOverwritten()
+            last_entry_idx = request.prev_entry_idx + len(request.entries)
+            message = RPC(self.id, self.term, MessageType.APPEND_ENTRY_RESPONSE,
+                          AppendEntryResponse(True, last_entry_idx, read_round=request.read_round,
+                                              entry_count=len(request.entries)))
+            newl = min(request.commit_idx, last_entry_idx)
+            if newl > self.commit_index:
+                logger.debug("Commiting entries from %s to %s", self.commit_index + 1, newl)
+                self.commit(newl)
+        else:
+            conflict_term, conflict_idx = self.log.conflict(request.prev_entry_idx)
+            message = RPC(self.id, self.term, MessageType.APPEND_ENTRY_RESPONSE,
+                          AppendEntryResponse(False, request.prev_entry_idx, conflict_term, conflict_idx,
+                                              request.read_round, len(request.entries)))
+        self.sendAfterSync(self.addressOf(sender), message)
+
+    def failOverwritten(self) -> None:
+        # Entries of a deposed leader replaced by the new leader never commit, their clients need not wait for
+        # another entry to be applied at the same index
+        for index in [index for index, (term, _) in self.commit_waiters.items()
+                      if index >= self.log.size() or index > self.log.base_index and self.log.term_at(index) != term]:
+            self.completeWaiter(self.commit_waiters.pop(index)[1], LeadershipLost(), None)
 
     def commitEntries(self):
-        book = {}
-        for server_id, commited_entries in self.match_index.items():
-            if commited_entries in book.keys():
-                book[commited_entries] += 1
-            else:
-                book[commited_entries] = 1
-        ranked = sorted(book.items(), key=lambda x: x[1], reverse=True)
-        logging.info(f"LOL ___ {ranked}")
-        for commits, count in ranked:
-            if count >= (len(SERVERS) + 1) / 2. and commits > self.commit_index and self.log[commits].term == self.term:
-                logging.info(f'Commiting entries from {self.commit_index + 1} to {commits} on master')
-                for entry in self.log[self.commit_index + 1: commits + 1]:
-                    res = self.storage.apply(entry)
-                    if res:
-                        entry.value = res
-                self.commit_index = commits
+        self.match_index[self.id] = self.log.synced_index
+        # The highest index replicated on a majority of servers
+        commits = self.configuration.agreed(self.match_index)
+        if commits > self.commit_index and self.log.term_at(commits) == self.term:
+            logger.debug("Commiting entries from %s to %s on master", self.commit_index + 1, commits)
+            self.commit(commits)
 
     def appendEntryResponse(self, response: AppendEntryResponse, sender: int, term: int) -> None:
         if term > self.term:
-            logging.info(f"New term ({term} > {self.term}), fallback to follower")
+            logger.info("New term (%s > %s), fallback to follower", term, self.term)
             self.fallback(term, sender)
             return
-        with self.lock:
-            if response.success:
-                logging.info(f"Successfully written data on replica")
-                self.next_index[sender] = min(self.next_index[sender] + 1, self.log.size())
-                self.match_index[sender] = min(self.match_index[sender] + 1, self.log.size() - 1)
-                self.commitEntries()
-            else:
-                self.next_index[sender] -= 1
-                index = self.next_index[sender]
-                message = RPC(self.id, self.term, MessageType.APPEND_ENTRY,
-                              AppendEntry(self.log[index], index - 1, self.log[index - 1].term, self.commit_index))
-                self.sendTo(SERVERS[sender], json.dumps(message).encode('utf-8'))
+        if not self.state == State.LEADER:
+            return
+        self.acked_round[sender] = max(self.acked_round[sender], response.read_round)
+        self.confirmRounds()
+        if response.entry_count:
+            self.inflight[sender] = max(self.inflight[sender] - 1, 0)
+        if response.success:
+            logger.debug("Successfully written data on replica up to %s", response.last_entry_idx)
+            self.match_index[sender] = max(self.match_index[sender], response.last_entry_idx)
+            self.next_index[sender] = max(self.next_index[sender], response.last_entry_idx + 1)
+            self.sent_index[sender] = max(self.sent_index[sender], self.next_index[sender])
+            self.commitEntries()
+            self.wakeCatchUpWaiters(sender)
+        elif response.last_entry_idx < self.next_index[sender]:
+            # Replica has no entry matching prev_entry_idx, skip its whole conflicting term or its missing suffix
+            next_index = response.conflict_idx
+            if response.conflict_term != -1:
+                last_index = self.log.last_index(response.conflict_term)
+                if last_index is not None:
+                    next_index = last_index + 1
+            self.next_index[sender] = max(min(next_index, response.last_entry_idx), 1)
+            self.match_index[sender] = min(self.match_index[sender], self.next_index[sender] - 1)
+            self.inflight[sender] = 0
+        if self.inflight[sender] == 0:
+            # Everything sent past next_index without an acknowledgement was lost or rejected
+            self.sent_index[sender] = self.next_index[sender]
+        self.replicate(sender)
+
+    def snapshotOffset(self, server_id: int) -> int:
+        index, offset = self.snapshot_progress.get(server_id, (0, 0))
+        return offset if index == self.log.base_index else 0
+
+    def sendSnapshotChunk(self, server_id: int, offset: int) -> None:
+        data: str = self.log.snapshot
+        chunk: str = data[offset: offset + SNAPSHOT_CHUNK_SIZE]
+        done: bool = offset + len(chunk) >= len(data)
+        message = RPC(self.id, self.term, MessageType.INSTALL_SNAPSHOT,
+                      InstallSnapshot(self.log.base_index, self.log.term_at(self.log.base_index), offset, chunk, done,
+                                      self.log.base_config or ""))
+        self.inflight[server_id] += 1
+        self.sendTo(self.addressOf(server_id), message)
+
+    def installSnapshot(self, request: InstallSnapshot, sender: int, term: int) -> None:
+        self.followLeader(sender, term)
+        if request.offset == 0 and (request.last_included_idx, sender) != (self.snapshot_index, self.snapshot_sender):
+            # A resent first chunk of the same transfer must not discard the chunks received since
+            self.snapshot_chunks = []
+            self.snapshot_index = request.last_included_idx
+            self.snapshot_sender = sender
+        received: int = sum(len(chunk) for chunk in self.snapshot_chunks)
+        if request.last_included_idx == self.snapshot_index and request.offset == received:
+            self.snapshot_chunks += [request.data]
+            received += len(request.data)
+        done: bool = (request.done and request.last_included_idx == self.snapshot_index and
+                      request.offset + len(request.data) == received)
+        if done and request.last_included_idx > self.commit_index:
+            logger.info("Install snapshot up to %s from %s", request.last_included_idx, sender)
+            data: str = "".join(self.snapshot_chunks)
+            self.log.install_snapshot(request.last_included_idx, request.last_included_term, data,
+                                      request.configuration or None)
+            self.updateConfiguration()
+            self.storage.loads(data)
+            # Entries covered by the snapshot were never applied here, so their results are unknown
+            for index in [index for index in self.commit_waiters.keys() if index <= request.last_included_idx]:
+                self.completeWaiter(self.commit_waiters.pop(index)[1], LeadershipLost(), None)
+            self.failOverwritten()
+            self.commit_index = request.last_included_idx
+            self.last_applied = request.last_included_idx
+            self.wakeApplyWaiters()
+        if done:
+            self.snapshot_chunks = []
+        message = RPC(self.id, self.term, MessageType.INSTALL_SNAPSHOT_RESPONSE,
+                      InstallSnapshotResponse(request.last_included_idx, received, done))
+        self.sendAfterSync(self.addressOf(sender), message)
+
+    def installSnapshotResponse(self, response: InstallSnapshotResponse, sender: int, term: int) -> None:
+        if term > self.term:
+            logger.info("New term (%s > %s), fallback to follower", term, self.term)
+            self.fallback(term, sender)
+            return
+        if not self.state == State.LEADER:
+            return
+        self.inflight[sender] = max(self.inflight[sender] - 1, 0)
+        if response.last_included_idx != self.log.base_index:
+            # Log was compacted again during the transfer, next attempt sends the newer snapshot
+            self.snapshot_progress.pop(sender, None)
+            self.sent_index[sender] = self.next_index[sender]
+        elif response.done:
+            logger.info("Snapshot up to %s installed on replica", response.last_included_idx)
+            self.snapshot_progress.pop(sender, None)
+            self.match_index[sender] = max(self.match_index[sender], response.last_included_idx)
+            self.next_index[sender] = max(self.next_index[sender], response.last_included_idx + 1)
+            self.sent_index[sender] = self.next_index[sender]
+            self.commitEntries()
+            self.wakeCatchUpWaiters(sender)
+        else:
+            offset: int = self.snapshotOffset(sender)
+            self.snapshot_progress[sender] = (response.last_included_idx, response.offset)
+            if response.offset <= offset:
+                # Answer to a resent or lost chunk: the transfer goes on from the other answer or the next heartbeat
+                return
+            self.sendSnapshotChunk(sender, response.offset)
+        self.replicate(sender)
+
+    def readIndex(self, request: ReadIndex, sender: int, term: int) -> None:
+        if term > self.term:
+            self.fallback(term, None)
+        task = self.loop.create_task(self.serveReadIndex(request, sender))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def serveReadIndex(self, request: ReadIndex, sender: int) -> None:
+        try:
+            read_index: int = await self.confirmReadIndex()
+        except LeadershipLost:
+            read_index = -1
+        self.sendTo(self.addressOf(sender), RPC(self.id, self.term, MessageType.READ_INDEX_RESPONSE,
+                                         ReadIndexResponse(request.request_id, read_index)))
+
+    def readIndexResponse(self, response: ReadIndexResponse, sender: int, term: int) -> None:
+        future = self.read_requests.get(response.request_id)
+        if future is None:
+            return
+        if response.read_index < 0:
+            self.completeWaiter(future, ReadUnavailable(), None)
+        else:
+            self.completeWaiter(future, None, response.read_index)
+
+    def summary(self):
+        return {
+            "group": self.group,
+            "state": self.state.name,
+            "term": self.term,
+            "leader_id": self.leader_id,
+            "voted_for": self.voted_for,
+            "commit_index": self.commit_index,
+            "last_applied": self.last_applied,
+            "log": self.log.summary(),
+            "configuration": self.configuration,
+            "config_index": self.config_index,
+            "storage_size": len(self.storage.storage),
+            "next_index": self.next_index,
+            "match_index": self.match_index,
+            "pending_clients": len(self.client_entries) + len(self.commit_waiters),
+            "pending_reads": len(self.read_waiters) + len(self.apply_waiters)
+        }
 
     def __json__(self):
         return {
             "address": self.address,
             "id": self.id,
+            "group": self.group,
             "state": self.state.name,
             "term": self.term,
             "log": self.log,
             "commit_index": self.commit_index,
+            "last_applied": self.last_applied,
             "storage": self.storage,
             "leader_id": self.leader_id,
             "voted_for": self.voted_for,
+            "configuration": self.configuration,
             "approves": list(self.approves),
             "election_timer": self.election_timer,
             "next_index": self.next_index,
-            "match_index": self.match_index,
-            "heartbeat_timer": self.heartbeat_timer
-        }
+            "match_index": self.match_index
+        }
\ No newline at end of file
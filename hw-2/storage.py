@@ -1,17 +1,24 @@
+import json
 import logging
-from typing import Optional
+from itertools import islice
+from typing import Iterator, Optional
 
 from log import Entry, Event
 
+logger = logging.getLogger("raft.storage")
+
+# Keys serialized at a time while taking a snapshot, a slice takes about 10 ms
+SNAPSHOT_SLICE_SIZE = 8192
+
 
 class Storage:
     def __init__(self) -> None:
         self.storage: dict[str, int] = {}
 
     def apply(self, entry: Entry) -> Optional[int]:
-        logging.info(f"Apply entry: {entry}")
+        logger.debug("Apply entry: %s", entry)
         match entry.event:
-            case Event.NOOP:
+            case Event.NOOP | Event.CONFIG:
                 return
             case Event.GET:
                 return self.get(entry.key)
@@ -21,9 +28,28 @@ class Storage:
                 return self.set(entry.key, entry.value)
             case Event.DELETE:
                 return self.delete(entry.key)
+            case Event.BATCH:
+                return self.apply_batch(entry.operations)
             case _:
                 raise RuntimeError(f"Unknown event {entry.event}")
 
+    def apply_batch(self, operations: list[Entry]) -> list[Optional[int]]:
+        # Whole batch is applied within one entry, so nobody observes it half done
+        results: list[Optional[int]] = []
+        for operation in operations:
+            match operation.event:
+                case Event.GET:
+                    results.append(self.get(operation.key))
+                case Event.POST | Event.PUT:
+                    results.append(self.set(operation.key, operation.value))
+                case Event.DELETE:
+                    # Deleting a missing key must not fail the rest of the batch
+                    self.storage.pop(operation.key, None)
+                    results.append(None)
+                case _:
+                    raise RuntimeError(f"Unsupported batch operation {operation.event}")
+        return results
+
     def get(self, key: str) -> int:
         return self.storage.get(key, None)
 
@@ -33,5 +59,30 @@ class Storage:
     def delete(self, key: str) -> None:
         del self.storage[key]
 
+    def dumps(self) -> str:
+        return json.dumps(self.storage)
+
+    def snapshot(self) -> Iterator[str]:
+        # Copy is taken right away, its slices may be serialized while later entries are applied
+        return self.dump_slices(self.storage.copy())
+
+    @staticmethod
+    def dump_slices(storage: dict[str, int]) -> Iterator[str]:
+        # Joined, the slices are the same as json.dumps(storage)
+        items = iter(storage.items())
+        yield "{"
+        separator = ""
+        while slice_ := dict(islice(items, SNAPSHOT_SLICE_SIZE)):
+            yield separator + json.dumps(slice_)[1:-1]
+            separator = ", "
+        yield "}"
+
+    def loads(self, data: str) -> None:
+        self.storage = json.loads(data)
+
+    def page(self, offset: int, limit: int):
+        return {"size": len(self.storage), "offset": offset,
+                "storage": dict(islice(self.storage.items(), offset, offset + limit))}
+
     def __json__(self):
         return {"storage": self.storage}
@@ -1,49 +1,62 @@
+import asyncio
 import logging
-from threading import Timer as ThreadTimer
+from typing import Optional
+
+logger = logging.getLogger("raft.timer")
 
 
 class Timer:
-    def __init__(self, name: str, duration: float, callback, auto_start: bool = True, renewable: bool = True):
+    def __init__(self, name: str, duration: float, callback, auto_start: bool = True, renewable: bool = True,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
         self.name: str = name
         self.duration = duration
         self.callback = callback
         self.renewable: bool = renewable
         self.started = False
         self.cancelled = False
-        self.timer: ThreadTimer = None
+        self.loop = loop or asyncio.get_running_loop()
+        self.deadline: float = 0
+        self.handle: Optional[asyncio.TimerHandle] = None
         if auto_start:
             self.start()
 
     def start(self):
         if not self.started:
-            self.timer = ThreadTimer(self.duration, self.timeout)
-            self.timer.start()
+            self.restart()
             self.started = True
 
     def cancel(self):
-        if self.timer and not self.cancelled:
-            self.cancelled = True
-            self.timer.cancel()
+        self.cancelled = True
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
 
     def restart(self):
-        self.cancel()
-        self.timer = ThreadTimer(self.duration, self.timeout)
-        self.timer.start()
+        # Restarts only move the deadline, the scheduled handle catches up with it when it fires
+        self.deadline = self.loop.time() + self.duration
         self.cancelled = False
+        if self.handle and self.handle.when() > self.deadline:
+            self.handle.cancel()
+            self.handle = None
+        if not self.handle:
+            self.handle = self.loop.call_at(self.deadline, self.timeout)
 
     def reschedule(self, duration: float):
         self.duration = duration
         self.restart()
 
     def timeout(self):
+        if self.loop.time() < self.deadline:
+            self.handle = self.loop.call_at(self.deadline, self.timeout)
+            return
+        self.handle = None
         try:
-            logging.info(f"Timer '{self.name}' timed out. Running callback {self.callback}")
+            logger.debug("Timer '%s' timed out. Running callback %s", self.name, self.callback)
             self.callback()
         except BaseException as exception:
-            logging.exception(exception)
-        if self.renewable:
-            self.timer = ThreadTimer(self.duration, self.timeout)
-            self.timer.start()
+            logger.exception(exception)
+        if self.renewable and not self.handle and not self.cancelled:
+            self.restart()
 
     def __json__(self):
         return {"name": self.name, "duration": self.duration, "renewable": self.renewable, "started": self.started, "cancelled": self.cancelled}
\ No newline at end of file
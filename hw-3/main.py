@@ -10,27 +10,33 @@ _default.default = JSONEncoder().default
 JSONEncoder.default = _default
 
 import logging
-from logging import config
 import os
 import sys
 from contextlib import asynccontextmanager
 from typing import Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response
 import uvicorn
 
-from server import Server
+import logsetup
+from server import Server, MAX_SYNC_SIZE
 from models import CRDTRequest, CRDTResponse
 
+MAX_PAGE_SIZE = 1000
+# Key is synced in its insert and its remove record, which share a chunk; 1 KiB is left for senders and timestamps
+MAX_PAIR_SIZE = MAX_SYNC_SIZE // 2 - 1024
+
 server: Server
 
+logger = logging.getLogger("app")
+
 
 @asynccontextmanager
 async def lifespan(app):
     global server
     if len(sys.argv) < 2:
         raise RuntimeError("Not enough arguments\nUsage: python main.py <server_id>")
-    logging.info(f"Starting server with ID: {sys.argv[2]}")
+    logger.info("Starting server with ID: %s", sys.argv[2])
     server = Server(sys.argv[2])
     yield
     print("Shutdown")
@@ -41,26 +47,49 @@ app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 async def root():
-    logging.info(f"App: Root access")
+    logger.info("App: Root access")
     return "I am alive!"
 
 
+def json_response(content) -> Response:
+    # Serialized once with the __json__ hooks, without a round trip through Python objects
+    return Response(json.dumps(content), media_type="application/json")
+
+
+def page_bounds(offset: int, limit: int) -> tuple[int, int]:
+    return max(offset, 0), min(max(limit, 0), MAX_PAGE_SIZE)
+
+
 @app.get("/view")
-async def root():
-    logging.info(f"App: View access")
-    return json.loads(json.dumps(server, indent=4))
+async def view():
+    logger.info("App: View access")
+    return json_response(server.summary())
+
+
+@app.get("/view/messages")
+async def view_messages(offset: int = 0, limit: int = 100):
+    return json_response(server.network.messagesPage(*page_bounds(offset, limit)))
+
+
+@app.get("/view/storage")
+async def view_storage(offset: int = 0, limit: int = 100):
+    return json_response(server.storage.page(*page_bounds(offset, limit)))
 
 
 @app.get("/storage")
 async def get_value(key: str):
-    logging.info(f"App: Got GET request for key: {key}")
+    logger.info("App: Got GET request for key: %s", key)
     result: Optional[int] = server.on_get(key)
     return CRDTResponse(value=result)
 
 
 @app.patch("/storage")
 async def add_value(request: CRDTRequest):
-    logging.info(f"App: Got request: {request}")
+    logger.info("App: Got request: %s", request)
+    # Pairs are broadcast in one datagram and synced in chunks of one at most, larger ones never reach the peers
+    if (len(json.dumps(request.data)) > MAX_SYNC_SIZE or
+            any(len(json.dumps({key: value})) > MAX_PAIR_SIZE for key, value in request.data.items())):
+        raise HTTPException(status_code=413, detail="Too large to replicate")
     _: int = server.on_patch(request.data)
     return CRDTResponse(value="OK")
 
@@ -69,6 +98,7 @@ if __name__ == "__main__":
     if len(sys.argv) < 3:
         raise RuntimeError("Not enough arguments\nUsage: python main.py <port> <server_id>")
     os.environ["PATH_TO_LOG_FILE"] = f"server_{sys.argv[2]}.log"
-    logging.config.fileConfig("logging.conf")
-    logging.info(f"Starting FastAPI server at: {sys.argv[1]}")
-    uvicorn.run(app, host="0.0.0.0", port=int(sys.argv[1]), log_config="logging.conf", log_level="info")
+    logsetup.configure("logging.conf", ("crdt.rpc",))
+    logger.info("Starting FastAPI server at: %s", sys.argv[1])
+    # Logging is already configured, uvicorn loggers propagate to the queue
+    uvicorn.run(app, host="0.0.0.0", port=int(sys.argv[1]), log_config=None, log_level="info")
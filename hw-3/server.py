@@ -1,19 +1,45 @@
 import copy
+import hashlib
 import json
 import logging
 import socket
+import uuid
+import zlib
+from collections import OrderedDict
 from enum import IntEnum
+from itertools import islice
 from threading import Thread, Lock
 from time import sleep
 from typing import Any, Callable, Optional
 
-from timer import Timer
+from timer import Scheduler
+
+logger = logging.getLogger("crdt")
+# Message bodies are logged at DEBUG only, they cost a JSON dump of every message
+rpc_logger = logging.getLogger("crdt.rpc")
 
 SERVERS = {
     "0": ("127.0.0.2", 32000),
     "1": ("127.0.0.3", 32000),
     "2": ("127.0.0.4", 32000),
 }
+SYNC_INTERVAL = 10
+RECEIVE_BUFFER_SIZE = 65536
+# Records of a delta are split into chunks of at most this size, the rest of the 65507 bytes a datagram can hold is
+# left for the message around them
+MAX_SYNC_SIZE = 56 * 1024
+ANTI_ENTROPY_INTERVAL = 30
+# Unacknowledged broadcasts are sent again after this delay, doubled on every attempt up to the maximum
+RETRANSMIT_TIMEOUT = 1
+MAX_RETRANSMIT_TIMEOUT = 32
+# Hash tree over the key space: every inner node has MERKLE_FANOUT children, leaves are buckets of keys
+MERKLE_FANOUT = 16
+MERKLE_DEPTH = 2
+MERKLE_BUCKETS = MERKLE_FANOUT ** MERKLE_DEPTH
+
+
+def digest(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
 
 
 class Timestamps:
@@ -56,6 +82,9 @@ class Timestamps:
 class MessageType(IntEnum):
     EVENT = 0
     SYNC = 1
+    SYNC_ACK = 2
+    MERKLE_DIGESTS = 3
+    MERKLE_RECORDS = 4
 
 
 class Message:
@@ -77,6 +106,9 @@ class Message:
         data = message['data']
         return Message(type_, sender, id_, tmp, data)
 
+    def __str__(self):
+        return json.dumps(self)
+
     def __json__(self):
         return {
             'type': self.type.value,
@@ -92,28 +124,47 @@ class ReliableCausalBroadcast:
         self.id: str = id_
         self.servers: dict[str, tuple[str, int]] = SERVERS
         self.ct: int = 0
-        self.pending: list[tuple[str, int]] = []
-        self.delivered: list[tuple[str, int]] = []
+        # Pending messages of every origin by sequence number, only the next one of an origin can be delivered
+        self.pending: dict[str, dict[int, tuple[str, int]]] = {}
+        # Origins whose next message waits for the clock of another server to advance
+        self.blocked: dict[str, set[str]] = {}
         self.acks: dict[tuple[str, int], set[str]] = {}
         self.mapping: dict[tuple[str, int], Message] = {}
+        # Delivered messages of every origin, origins deliver in sequence so the clock is the delivered watermark
         self.timestamps: Timestamps = Timestamps(list(self.servers.keys()))
+        # Delivered watermarks last reported by the other servers, and the watermark delivered everywhere.
+        # Messages up to the stable watermark are never needed again and are dropped
+        self.clocks: dict[str, dict[str, int]] = {
+            server_id: {origin: 0 for origin in self.servers.keys()} for server_id in self.servers.keys()
+            if server_id != self.id
+        }
+        self.stable: dict[str, int] = {origin: 0 for origin in self.servers.keys()}
         self.delivery_callback: Callable = delivery_callback
-        self.timers: dict[tuple[str, int], Timer] = {}
+        # Current retransmission delay of own messages some server has not acknowledged yet
+        self.retransmits: dict[tuple[str, int], float] = {}
+        self.scheduler: Scheduler = Scheduler('Retransmit', self.on_retransmit)
         self.lock = Lock()
 
+    def start(self):
+        # Receiving starts once the owner holds the network, its callback may use it right away
         Thread(target=self._pollMessages).start()
 
-    def _broadcast(self, message: Message):
-        logging.info(f"BROADCAST -> {json.dumps(message)}")
+    def _broadcast(self, message: Message, server_ids: Optional[list[str]] = None):
+        rpc_logger.debug("BROADCAST -> %s", message)
         self_send = message.type == MessageType.EVENT
         message = json.dumps(message).encode('utf-8')
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         for server_id, address in self.servers.items():
-            if server_id == self.id and not self_send:
+            if server_id == self.id and not self_send or server_ids is not None and server_id not in server_ids:
                 continue
             n = sock.sendto(message, address)
             if n != len(message):
-                logging.critical(f"Datagram split: {n} sent instead of {len(message)}")
+                logger.critical("Datagram split: %s sent instead of %s", n, len(message))
+
+    def sendMessage(self, server_id: str, message: Message):
+        rpc_logger.debug("SEND -> %s", message)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(json.dumps(message).encode('utf-8'), self.servers[server_id])
 
     def broadcastMessage(self, message_type: MessageType, data: Any) -> tuple[str, int]:
         with self.lock:
@@ -124,10 +175,10 @@ class ReliableCausalBroadcast:
             self._broadcast(message)
             if message_type == MessageType.EVENT:
                 self.mapping[message.id] = message
-                self.pending += [message.id]
+                self.pending.setdefault(self.id, {})[message.id[1]] = message.id
                 self.acks[message.id] = set()
-                self.timers[message.id] = Timer('MSG BRDCST RPT', 10, self.on_timer, message.id, renewable=True)
-                self.timers[message.id].start()
+                self.retransmits[message.id] = RETRANSMIT_TIMEOUT
+                self.scheduler.schedule(message.id, RETRANSMIT_TIMEOUT)
         return message.id
 
     def _pollMessages(self):
@@ -139,80 +190,151 @@ class ReliableCausalBroadcast:
             sock.settimeout(1)
             while True:
                 try:
-                    message, address = sock.recvfrom(4096)
+                    message, address = sock.recvfrom(RECEIVE_BUFFER_SIZE)
                 except socket.timeout:
-                    logging.info("")
                     continue
 
-                message = Message.decode(json.loads(message.decode('utf-8')))
-                logging.info(f"RECEIVE <- {json.dumps(message)}")
-                if message.type == MessageType.EVENT:
-                    self._processMessage(message)
-                elif message.type == MessageType.SYNC:
-                    self.delivery_callback(message)
+                try:
+                    message = Message.decode(json.loads(message.decode('utf-8')))
+                    rpc_logger.debug("RECEIVE <- %s", message)
+                    if message.type == MessageType.EVENT:
+                        self._processMessage(message)
+                    elif message.type in (MessageType.SYNC, MessageType.SYNC_ACK, MessageType.MERKLE_DIGESTS,
+                                          MessageType.MERKLE_RECORDS):
+                        if message.type == MessageType.SYNC:
+                            self.observeClock(message.sender, message.timestamps.timestamps)
+                        self.delivery_callback(message)
+                except Exception as exception:
+                    # A message that fails to be handled, or to be answered, must not stop the receiving
+                    logger.exception(exception)
         except BaseException as exception:
-            logging.exception(exception)
+            logger.exception(exception)
 
     def _processMessage(self, message: Message):
+        relay: str = message.sender
+        origin: str = message.id[0]
         with self.lock:
+            if message.id not in self.mapping.keys() and self.isDelivered(message.id):
+                # Late copy of a message collected as stable
+                return
             if message.id not in self.mapping.keys():
+                # Relayed copies carry the relay as sender, the stored message is attributed to its origin
+                message.sender = origin
                 self.mapping[message.id] = message
-                self.acks[message.id] = {message.sender}
-                self.pending += [message.id]
-                if message.sender != self.id:
+                self.acks[message.id] = {relay}
+                self.pending.setdefault(origin, {})[message.id[1]] = message.id
+                if relay != self.id:
                     msg = copy.deepcopy(message)
                     msg.sender = self.id
                     self._broadcast(msg)
             else:
-                self.acks[message.id].add(message.sender)
-        self._deliver()
+                self.acks[message.id].add(relay)
+        self._deliver({origin})
 
-    def _deliver(self):
-        delivered = False
+    def _deliver(self, origins: set[str]):
+        # Checks only the origins whose next message could have become deliverable, and drains them in a loop
         with self.lock:
-            for message_id in self.pending:
-                message: Message = self.mapping[message_id]
-                if len(self.acks[message_id]) < (len(self.servers) + 1) / 2. or self.timestamps[message.sender] + 1 != \
-                        message.timestamps[message.sender]:
+            while origins:
+                origin = origins.pop()
+                message_id = self.pending.get(origin, {}).get(self.timestamps[origin] + 1)
+                if message_id is None or len(self.acks[message_id]) < (len(self.servers) + 1) / 2.:
                     continue
-                deliverable = True
-                for server_id in self.servers.keys():
-                    if server_id != message.sender and self.timestamps[server_id] < message.timestamps[server_id]:
-                        deliverable = False
-                        break
-                if not deliverable:
+                message: Message = self.mapping[message_id]
+                dependency = next((server_id for server_id in self.servers.keys()
+                                   if server_id != origin and self.timestamps[server_id] < message.timestamps[server_id]),
+                                  None)
+                if dependency is not None:
+                    self.blocked.setdefault(dependency, set()).add(origin)
                     continue
 
-                logging.info(f"DELIVERED -> {json.dumps(message)}")
+                rpc_logger.debug("DELIVERED -> %s", message)
                 self.delivery_callback(message)
 
-                delivered = True
-                self.delivered += [message_id]
-                self.pending.remove(message_id)
-                timer = self.timers.pop(message_id, None)
-                if timer:
-                    timer.cancel()
-                self.timestamps[message.sender] += 1
-                break
-        if delivered:
-            self._deliver()
-
-    def on_timer(self, message_id: tuple[str, int]):
-        logging.info(f"TIMER -> {message_id}")
+                del self.pending[origin][message_id[1]]
+                self.timestamps[origin] += 1
+                # Next message of the origin, and the messages waiting for its clock, may be deliverable now
+                origins.add(origin)
+                origins |= self.blocked.pop(origin, set())
+
+    def isPending(self, message_id: tuple[str, int]) -> bool:
+        return message_id[1] in self.pending.get(message_id[0], {})
+
+    def isDelivered(self, message_id: tuple[str, int]) -> bool:
+        return message_id[1] <= self.timestamps[message_id[0]]
+
+    def clock(self) -> Timestamps:
         with self.lock:
-            if message_id in self.pending:
-                self._broadcast(self.mapping[message_id])
-            else:
-                timer = self.timers.pop(message_id, None)
-                if timer:
-                    timer.cancel()
+            return copy.deepcopy(self.timestamps)
+
+    def observeClock(self, server_id: str, timestamps: dict[str, int]):
+        with self.lock:
+            clock = self.clocks.get(server_id)
+            if clock is None:
+                return
+            for origin, delivered in timestamps.items():
+                if origin in clock:
+                    clock[origin] = max(clock[origin], delivered)
+            self.collect()
+
+    def collect(self):
+        for origin in self.servers.keys():
+            stable = min([self.timestamps[origin]] + [clock[origin] for clock in self.clocks.values()])
+            for sequence in range(self.stable[origin] + 1, stable + 1):
+                self.mapping.pop((origin, sequence), None)
+                self.acks.pop((origin, sequence), None)
+                if self.retransmits.pop((origin, sequence), None) is not None:
+                    self.scheduler.cancel((origin, sequence))
+            self.stable[origin] = max(self.stable[origin], stable)
+
+    def on_retransmit(self, message_id: tuple[str, int]):
+        rpc_logger.debug("RETRANSMIT -> %s", message_id)
+        with self.lock:
+            delay = self.retransmits.get(message_id)
+            if delay is None:
+                return
+            # Every server relays its first copy, so a server missing from the acks has not got the message
+            unacked = [server_id for server_id in self.servers.keys() if server_id not in self.acks[message_id]]
+            if not unacked:
+                del self.retransmits[message_id]
+                return
+            self._broadcast(self.mapping[message_id], unacked)
+            delay = min(delay * 2, MAX_RETRANSMIT_TIMEOUT)
+            self.retransmits[message_id] = delay
+            self.scheduler.schedule(message_id, delay)
+
+    def summary(self):
+        # Copied under the lock, serialized by the caller after it is released
+        with self.lock:
+            return {
+                'id': self.id,
+                'ct': self.ct,
+                'pending': sum(len(queue) for queue in self.pending.values()),
+                'delivered': sum(self.timestamps.timestamps.values()),
+                'stable': dict(self.stable),
+                'messages': len(self.mapping),
+                'retransmits': len(self.retransmits),
+                'timestamps': dict(self.timestamps.timestamps),
+            }
+
+    def messagesPage(self, offset: int, limit: int):
+        with self.lock:
+            return {
+                'size': len(self.mapping),
+                'offset': offset,
+                'messages': [
+                    {'id': message_id, 'pending': self.isPending(message_id), 'acks': sorted(self.acks.get(message_id, ())),
+                     'message': message}
+                    for message_id, message in islice(self.mapping.items(), offset, offset + limit)
+                ],
+            }
 
     def __json__(self):
         return {
             'id': self.id,
             'ct': self.ct,
-            'pending': [str(x) for x in self.pending],
-            'delivered': [str(x) for x in self.delivered],
+            'pending': [str(x) for queue in self.pending.values() for x in queue.values()],
+            'delivered': self.timestamps,
+            'stable': self.stable,
             'acks': {str(k): list(v) for k, v in self.acks.items()},
             'mapping': {str(k): v for k, v in self.mapping.items()},
             'timestamps': self.timestamps,
@@ -223,6 +345,14 @@ class Storage:
     def __init__(self):
         self.inserts: dict[str, tuple[str, Timestamps, int]] = {}
         self.removes: dict[str, tuple[str, Timestamps]] = {}
+        # Local version of the last change of every key, keys ordered by it
+        self.version: int = 0
+        self.versions: OrderedDict[str, int] = OrderedDict()
+        # Hash of every key with its state, and per bucket the keys and the xor of their hashes
+        self.hashes: dict[str, int] = {}
+        self.bucket_keys: list[set[str]] = [set() for _ in range(MERKLE_BUCKETS)]
+        self.leaves: list[int] = [0] * MERKLE_BUCKETS
+        self.tree: Optional[list[list[int]]] = None
         self.lock = Lock()
 
     def get(self, key: str) -> Optional[int]:
@@ -244,6 +374,7 @@ class Storage:
                 return
         with self.lock:
             self.inserts[key] = (sender, timestamps, value)
+            self.touch(key)
 
     def delete(self, key: str, sender: str, timestamps: Timestamps):
         last_remove = self.removes.get(key, None)
@@ -253,26 +384,106 @@ class Storage:
                 return
         with self.lock:
             self.removes[key] = (sender, timestamps)
+            self.touch(key)
+
+    def touch(self, key: str):
+        self.version += 1
+        self.versions[key] = self.version
+        self.versions.move_to_end(key)
+        record = json.dumps([key, self.inserts.get(key), self.removes.get(key)], sort_keys=True)
+        key_digest = digest(record.encode('utf-8'))
+        bucket = self.bucket(key)
+        # Xor lets a bucket digest follow a single key change without rehashing the other keys
+        self.leaves[bucket] ^= self.hashes.get(key, 0) ^ key_digest
+        self.hashes[key] = key_digest
+        self.bucket_keys[bucket].add(key)
+        self.tree = None
+
+    @staticmethod
+    def bucket(key: str) -> int:
+        return zlib.crc32(key.encode('utf-8')) % MERKLE_BUCKETS
 
-    def to_json(self) -> str:
+    def digests(self, level: int, nodes: list[int]) -> dict[int, int]:
         with self.lock:
-            return json.dumps({
-                "inserts": {k: (v[0], v[1].timestamps, v[2]) for k, v in self.inserts.items()},
-                "removes": {k: (v[0], v[1].timestamps) for k, v in self.removes.items()},
-            })
-
-    def from_json(self, data: str):
-        data = json.loads(data)
-        self.inserts = data["inserts"]
-        self.removes = data["removes"]
-        for k, v in self.inserts.items():
-            ts = Timestamps([])
-            ts.timestamps = v[1]
-            self.inserts[k] = (v[0], ts, v[2])
-        for k, v in self.removes.items():
-            ts = Timestamps([])
-            ts.timestamps = v[1]
-            self.removes[k] = (v[0], ts)
+            if self.tree is None:
+                self.tree = [self.leaves]
+                for _ in range(MERKLE_DEPTH):
+                    children = self.tree[0]
+                    self.tree.insert(0, [
+                        digest(b"".join(child.to_bytes(8, "big") for child in children[i: i + MERKLE_FANOUT]))
+                        for i in range(0, len(children), MERKLE_FANOUT)
+                    ])
+            return {node: self.tree[level][node] for node in nodes}
+
+    def records(self, keys: list[str]) -> list[tuple[int, dict]]:
+        # Records of the keys split into datagram sized chunks, with the number of keys in every chunk
+        chunks: list[tuple[int, dict]] = []
+        chunk: dict = {"inserts": {}, "removes": {}}
+        count: int = 0
+        size: int = 0
+        for key in keys:
+            insert = self.inserts.get(key)
+            remove = self.removes.get(key)
+            # Exact size the record adds to the encoded maps, key and separators included
+            record_size = ((len(json.dumps({key: insert})) if insert else 0) +
+                           (len(json.dumps({key: remove})) if remove else 0))
+            if record_size > MAX_SYNC_SIZE:
+                # No datagram can carry it. Still counted, so the versions of a delta move past it
+                logger.error("Record of key %.64s is %s bytes, larger than a sync chunk, not sent", key, record_size)
+                count += 1
+                continue
+            if size and size + record_size > MAX_SYNC_SIZE:
+                chunks.append((count, chunk))
+                chunk = {"inserts": {}, "removes": {}}
+                count = size = 0
+            if insert:
+                chunk["inserts"][key] = insert
+            if remove:
+                chunk["removes"][key] = remove
+            count += 1
+            size += record_size
+        chunks.append((count, chunk))
+        return chunks
+
+    def bucket_records(self, buckets: list[int]) -> list[dict]:
+        with self.lock:
+            return [chunk for _, chunk in self.records([key for bucket in buckets for key in self.bucket_keys[bucket]])]
+
+    def delta(self, since: int) -> list[dict]:
+        # State of the keys changed after version since, oldest changes first, split into datagram sized chunks.
+        # Version 0 gives the full state
+        with self.lock:
+            changed: list[tuple[str, int]] = []
+            for key, version in reversed(self.versions.items()):
+                if version <= since:
+                    break
+                changed.append((key, version))
+            changed.reverse()
+            chunks: list[dict] = []
+            start: int = since
+            position: int = 0
+            for count, chunk in self.records([key for key, _ in changed]):
+                position += count
+                end = changed[position - 1][1] if position else since
+                chunk["start"], chunk["end"] = start, end
+                chunks.append(chunk)
+                start = end
+            return chunks
+
+    def summary(self):
+        root = self.digests(0, [0])[0]
+        with self.lock:
+            return {"inserts": len(self.inserts), "removes": len(self.removes), "version": self.version,
+                    "merkle_root": root}
+
+    def page(self, offset: int, limit: int):
+        # Every key ever written has a hash, in the order it was first written
+        with self.lock:
+            return {
+                "size": len(self.hashes),
+                "offset": offset,
+                "storage": {key: self.get(key) for key in islice(self.hashes.keys(), offset, offset + limit)},
+            }
 
     def __json__(self):
         return {
@@ -283,24 +494,69 @@ class Storage:
 class Server:
     def __init__(self, server_id: str) -> None:
         self.id: str = server_id
-        self.network = ReliableCausalBroadcast(self.id, self.on_message_delivery)
         self.storage: Storage = Storage()
         self.storage_lock = Lock()
+        # Storage version acknowledged by every peer, and the version of every peer received without gaps.
+        # Epoch tells the versions of a restarted server apart from the previous run
+        self.epoch: str = uuid.uuid4().hex
+        self.acked: dict[str, int] = {server_id: 0 for server_id in SERVERS.keys() if server_id != self.id}
+        self.received: dict[str, tuple[str, int]] = {}
+        self.network = ReliableCausalBroadcast(self.id, self.on_message_delivery)
+        self.network.start()
 
         Thread(target=self.syncer).start()
+        Thread(target=self.antiEntropy).start()
 
 
     def syncer(self):
         while True:
-            self.network._broadcast(Message(MessageType.SYNC, self.id, (self.id, -1), None, self.storage.to_json()))
-            sleep(10)
+            for server_id, acked in list(self.acked.items()):
+                try:
+                    # A peer which has not acknowledged anything yet gets the full state
+                    for chunk in self.storage.delta(acked):
+                        chunk["epoch"] = self.epoch
+                        # Delivered watermark rides along, so peers learn which messages are stable
+                        self.network.sendMessage(server_id, Message(MessageType.SYNC, self.id, (self.id, -1),
+                                                                    self.network.clock(), chunk))
+                except Exception as exception:
+                    # Delta goes out again on the next round, a failed send must not end the syncer
+                    logger.exception(exception)
+            sleep(SYNC_INTERVAL)
+
+    def antiEntropy(self):
+        while True:
+            sleep(ANTI_ENTROPY_INTERVAL)
+            # Replicas in agreement stop at the root, diverged ones descend only into the mismatched subtrees
+            digests = self.storage.digests(0, [0])
+            for server_id in self.acked.keys():
+                self.network.sendMessage(server_id, Message(MessageType.MERKLE_DIGESTS, self.id, (self.id, -1), None,
+                                                            {"level": 0, "digests": digests}))
+
+    def on_merkle_digests(self, sender: str, level: int, digests: dict[int, int]):
+        own = self.storage.digests(level, list(digests.keys()))
+        mismatched = [node for node, digest in digests.items() if own[node] != digest]
+        if not mismatched:
+            return
+        if level < MERKLE_DEPTH:
+            children = [node * MERKLE_FANOUT + child for node in mismatched for child in range(MERKLE_FANOUT)]
+            self.network.sendMessage(sender, Message(MessageType.MERKLE_DIGESTS, self.id, (self.id, -1), None, {
+                "level": level + 1, "digests": self.storage.digests(level + 1, children)}))
+            return
+        logger.info("Replica %s diverged in %s buckets, exchange their keys", sender, len(mismatched))
+        self.send_bucket_records(sender, mismatched, True)
+
+    def send_bucket_records(self, server_id: str, buckets: list[int], reply: bool):
+        # Peer answers the first chunk with its own records of the same buckets
+        for i, chunk in enumerate(self.storage.bucket_records(buckets)):
+            chunk["buckets"] = buckets if reply and i == 0 else []
+            self.network.sendMessage(server_id, Message(MessageType.MERKLE_RECORDS, self.id, (self.id, -1), None, chunk))
 
     def on_get(self, key: str) -> Optional[int]:
         return self.storage.get(key)
 
     def on_patch(self, pairs: dict[str, Optional[int]]) -> None:
         message_id: tuple[str, int] = self.network.broadcastMessage(MessageType.EVENT, pairs)
-        # while not message_id in self.network.delivered:
+        # while not self.network.isDelivered(message_id):
         #     sleep(1)
 
     def on_message_delivery(self, message: Message):
@@ -312,17 +568,53 @@ class Server:
                     else:
                         self.storage.put(key, value, message.sender, message.timestamps)
             case MessageType.SYNC:
-                logging.info("Server received SYNC message, merge storages")
-                storage: Storage = Storage()
-                storage.from_json(message.data)
-                self.merge_storage(storage)
+                logger.debug("Server received SYNC message from %s, merge %s inserts and %s removes", message.sender,
+                             len(message.data["inserts"]), len(message.data["removes"]))
+                version = self.merge_delta(message.sender, message.data)
+                self.network.sendMessage(message.sender, Message(MessageType.SYNC_ACK, self.id, (self.id, -1), None,
+                                                                 {"epoch": message.data["epoch"], "version": version}))
+            case MessageType.MERKLE_DIGESTS:
+                self.on_merkle_digests(message.sender, message.data["level"],
+                                       {int(node): digest for node, digest in message.data["digests"].items()})
+            case MessageType.MERKLE_RECORDS:
+                with self.storage_lock:
+                    self.merge(message.data)
+                if message.data["buckets"]:
+                    self.send_bucket_records(message.sender, message.data["buckets"], False)
+            case MessageType.SYNC_ACK:
+                if message.data["epoch"] == self.epoch and message.sender in self.acked:
+                    # Taken as is, a restarted peer acknowledges less and gets the full state again
+                    self.acked[message.sender] = message.data["version"]
+
+    def merge(self, records: dict):
+        for key, (insert_sender, timestamps, value) in records["inserts"].items():
+            ts = Timestamps([])
+            ts.timestamps = timestamps
+            self.storage.put(key, value, insert_sender, ts)
+        for key, (remove_sender, timestamps) in records["removes"].items():
+            ts = Timestamps([])
+            ts.timestamps = timestamps
+            self.storage.delete(key, remove_sender, ts)
 
-    def merge_storage(self, storage: Storage):
+    def merge_delta(self, sender: str, delta: dict) -> int:
         with self.storage_lock:
-            for key, value in storage.inserts.items():
-                self.storage.put(key, value[2], value[0], value[1])
-            for key, value in storage.removes.items():
-                self.storage.delete(key, value[0], value[1])
+            self.merge(delta)
+            epoch, version = self.received.get(sender, (delta["epoch"], 0))
+            if epoch != delta["epoch"]:
+                version = 0
+            # Only a chunk continuing the received versions moves them forward, a lost one is sent again
+            if delta["start"] <= version:
+                version = max(version, delta["end"])
+            self.received[sender] = (delta["epoch"], version)
+            return version
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "network": self.network.summary(),
+            "storage": self.storage.summary(),
+            "sync": {"epoch": self.epoch, "acked": dict(self.acked)},
+        }
 
     def __json__(self):
         return {
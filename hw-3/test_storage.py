@@ -0,0 +1,63 @@
+import json
+
+import main  # noqa: F401, installs the __json__ hook of the encoder
+from server import Storage, Timestamps, Message, MessageType, MAX_SYNC_SIZE
+
+MAX_DATAGRAM_SIZE = 65507
+
+
+def timestamps(time: int) -> Timestamps:
+    result = Timestamps(["0", "1", "2"])
+    result["0"] = time
+    return result
+
+
+def record_size(storage: Storage, key: str) -> int:
+    return len(json.dumps({key: storage.inserts[key]})) + len(json.dumps({key: storage.removes[key]}))
+
+
+def fill(storage: Storage, key_size: int, time: int) -> str:
+    # Key inserted and removed, so it takes both records
+    key = str(time).ljust(key_size, "k")
+    storage.put(key, time, "0", timestamps(time))
+    storage.delete(key, "1", timestamps(time))
+    return key
+
+
+def sync_datagram(chunk: dict) -> int:
+    chunk["epoch"] = "e" * 32
+    message = Message(MessageType.SYNC, "0", ("0", -1), timestamps(0), chunk)
+    return len(json.dumps(message).encode('utf-8'))
+
+
+def test_record_near_limit_is_sent_alone():
+    storage = Storage()
+    small = fill(storage, 8, 1)
+    probe = fill(storage, 1, 2)
+    # Grow the key until the record is just below the chunk size
+    key_size = (MAX_SYNC_SIZE - record_size(storage, probe)) // 2
+    large = fill(storage, key_size, 3)
+    assert MAX_SYNC_SIZE - 16 < record_size(storage, large) <= MAX_SYNC_SIZE
+    chunks = storage.delta(0)
+    assert [list(chunk["inserts"]) for chunk in chunks] == [[small, probe], [large]]
+    assert [(chunk["start"], chunk["end"]) for chunk in chunks] == [(0, 4), (4, 6)]
+    assert all(sync_datagram(chunk) <= MAX_DATAGRAM_SIZE for chunk in chunks)
+
+
+def test_record_over_limit_is_skipped():
+    storage = Storage()
+    small = fill(storage, 8, 1)
+    large = fill(storage, MAX_SYNC_SIZE // 2, 2)
+    last = fill(storage, 8, 3)
+    assert record_size(storage, large) > MAX_SYNC_SIZE
+    chunks = storage.delta(0)
+    assert [key for chunk in chunks for key in chunk["inserts"]] == [small, last]
+    # Versions move past the skipped record, peers do not ask for it again
+    assert chunks[-1]["end"] == storage.version
+    assert all(sync_datagram(chunk) <= MAX_DATAGRAM_SIZE for chunk in chunks)
+    assert [key for chunk in storage.bucket_records(list(range(256))) for key in chunk["inserts"]].count(large) == 0
+
+
+if __name__ == '__main__':
+    test_record_near_limit_is_sent_alone()
+    test_record_over_limit_is_skipped()
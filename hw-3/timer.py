@@ -1,57 +1,50 @@
+import heapq
 import logging
-from threading import Timer as ThreadTimer
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+from typing import Any
 
+logger = logging.getLogger("crdt.timer")
 
-class Timer:
-    def __init__(self, name: str, duration: float, callback, data, auto_start: bool = True, renewable: bool = True):
+
+class Scheduler:
+    # One thread runs the callback for every scheduled key at its deadline, instead of a thread per timer
+    def __init__(self, name: str, callback):
         self.name: str = name
-        self.duration = duration
         self.callback = callback
-        self.data = data
-        self.renewable: bool = renewable
-        self.started = False
-        self.cancelled = False
-        self.timer: ThreadTimer = None
-        if auto_start:
-            self.start()
-
-    def start(self):
-        if not self.started:
-            self.timer = ThreadTimer(self.duration, self.timeout)
-            self.timer.start()
-            self.started = True
-
-    def cancel(self):
-        if self.timer and not self.cancelled:
-            self.cancelled = True
-            self.timer.cancel()
-
-    def restart(self):
-        self.cancel()
-        self.timer = ThreadTimer(self.duration, self.timeout)
-        self.timer.start()
-        self.cancelled = False
-
-    def reschedule(self, duration: float):
-        self.duration = duration
-        self.restart()
-
-    def timeout(self):
-        try:
-            logging.info(f"Timer '{self.name}' timed out. Running callback {self.callback} with data {self.data}")
-            self.callback(self.data)
-        except BaseException as exception:
-            logging.exception(exception)
-        if self.renewable:
-            self.timer = ThreadTimer(self.duration, self.timeout)
-            self.timer.start()
+        self.queue: list[tuple[float, int, Any]] = []
+        # Latest deadline of every key, queue entries not matching it were cancelled or rescheduled
+        self.deadlines: dict[Any, float] = {}
+        self.counter = count()
+        self.condition = Condition()
+        Thread(target=self.run).start()
+
+    def schedule(self, key, delay: float):
+        with self.condition:
+            deadline = monotonic() + delay
+            self.deadlines[key] = deadline
+            heapq.heappush(self.queue, (deadline, next(self.counter), key))
+            self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self.deadlines.pop(key, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > monotonic():
+                    self.condition.wait(self.queue[0][0] - monotonic() if self.queue else None)
+                deadline, _, key = heapq.heappop(self.queue)
+                if self.deadlines.get(key) != deadline:
+                    continue
+                del self.deadlines[key]
+            try:
+                logger.debug("Scheduler '%s' timed out. Running callback %s with data %s", self.name, self.callback, key)
+                self.callback(key)
+            except BaseException as exception:
+                logger.exception(exception)
 
     def __json__(self):
-        return {
-            "name": self.name,
-            "duration": self.duration,
-            "data": self.data,
-            "renewable": self.renewable,
-            "started": self.started,
-            "cancelled": self.cancelled
-        }
+        return {"name": self.name, "scheduled": len(self.deadlines)}